@@ -5,10 +5,17 @@ from mesa.datacollection import DataCollector
 from mesa.batchrunner import BatchRunner
 
 import csv
+import os
+import random
+import cProfile
+import pstats
+from functools import partial
+from time import perf_counter
 import matplotlib.pyplot as plt
 import numpy as np
 
 from hsolver import *
+from recorder import *
 
 
 # Define the required Parameters
@@ -20,16 +27,137 @@ ID_SP = 1000        # First ID number for SP
 
 DEM_AV = 3          # Demand average in SP
 DEM_SD = 2          # Demand st dev in SP
+DEM_PROB = 1/4      # Probability of demand in SP per step (as in SPAgent.out_items)
+
+AVG_SAMPLES = 100000    # Node pairs sampled for the average distance (exact if fewer pairs)
+
+# Timed phases of a model step (reported as "T_<phase>" in seconds)
+PHASES = ["collect", "schedule", "problem", "network", "assign", "route", "export", "step"]
 
 # Define the required Classes
 
-class DCAgent(Agent):
+class AgentStore():
+    """
+    Columnar state of the DC/SP agents: one array row per agent
+    (ID, position, products, demand, type) so that totals and the
+    problem export are whole-array operations
+    """
+    def __init__(self, size=0):
+        size = max(size, 1)
+        self.n = 0
+        self._ids = np.zeros(size, dtype=int)
+        self._pos = np.full((size, 2), np.nan)
+        self._products = np.zeros(size)
+        self._demand = np.zeros(size)
+        self._is_dc = np.zeros(size, dtype=bool)
+
+    def add (self, unique_id, agent_type):
+        """Append a row for a new agent and return its index"""
+        if self.n == len(self._ids):
+            # Double the arrays when full
+            size = 2 * self.n
+            self._ids = np.resize(self._ids, size)
+            self._pos = np.resize(self._pos, (size, 2))
+            self._products = np.resize(self._products, size)
+            self._demand = np.resize(self._demand, size)
+            self._is_dc = np.resize(self._is_dc, size)
+        row = self.n
+        self._ids[row] = unique_id
+        self._pos[row] = np.nan
+        self._products[row] = 0
+        self._demand[row] = 0
+        self._is_dc[row] = agent_type == "DC"
+        self.n += 1
+        return row
+
+    @property
+    def ids (self):
+        return self._ids[:self.n]
+
+    @property
+    def pos (self):
+        return self._pos[:self.n]
+
+    @property
+    def products (self):
+        return self._products[:self.n]
+
+    @property
+    def demand (self):
+        return self._demand[:self.n]
+
+    @property
+    def is_dc (self):
+        return self._is_dc[:self.n]
+
+    @property
+    def types (self):
+        return np.where(self.is_dc, "DC", "SP")
+
+    def total_products (self):
+        return float(self.products.sum())
+
+
+class StoreView():
+    """
+    Agent attributes (products, demand, pos) read from and written to the
+    model's AgentStore row once attached, plain attributes otherwise
+    """
+    _row = None
+
+    def attach (self, model):
+        """Take a row in model.store (if the model has one)"""
+        if getattr(model, "store", None) is not None:
+            pos = self.pos
+            self._row = model.store.add(self.unique_id, self.type)
+            self.pos = pos
+
+    @property
+    def products (self):
+        if self._row is None:
+            return self._products
+        return self.model.store._products[self._row]
+
+    @products.setter
+    def products (self, value):
+        if self._row is None:
+            self._products = value
+        else:
+            self.model.store._products[self._row] = value
+
+    @property
+    def demand (self):
+        if self._row is None:
+            return self._demand
+        return self.model.store._demand[self._row]
+
+    @demand.setter
+    def demand (self, value):
+        if self._row is None:
+            self._demand = value
+        else:
+            self.model.store._demand[self._row] = value
+
+    @property
+    def pos (self):
+        return self._pos
+
+    @pos.setter
+    def pos (self, value):
+        # The tuple is kept for mesa, the store gets a copy
+        self._pos = value
+        if self._row is not None:
+            self.model.store._pos[self._row] = (np.nan, np.nan) if value is None else value
+
+
+class DCAgent(StoreView, Agent):
     """Depot Center Agent"""
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
         self.model = model
-        self.products = PROD_DC
         self.type = "DC"
+        self.attach(model)
+        self.products = PROD_DC
         self.demand = 0
         self.sup_av = self.calc_supply()[0]
         self.sup_sd = self.calc_supply()[1]
@@ -53,9 +181,9 @@ class DCAgent(Agent):
         The average supply equates the minimum demand:
         N_SP*(DEM_AV-DEM_SD) = N_DC*SUP_AV
         """
-        sup_av = (self.model.N_SP/self.model.N_DC)*(DEM_AV-DEM_SD)
+        sup_av = (self.model.N_SP/self.model.N_DC)*(self.model.dem_av-self.model.dem_sd)
         # print("supply average: " + str(sup_av))
-        sup_sd = (self.model.N_SP/self.model.N_DC)*2*DEM_SD
+        sup_sd = (self.model.N_SP/self.model.N_DC)*2*self.model.dem_sd
         # print("supply std dev: " + str(sup_sd))
         return (sup_av, sup_sd)
         
@@ -63,16 +191,19 @@ class DCAgent(Agent):
         # print ("DC ID " + str(self.unique_id) +"- Products: " + str(self.products))
         #TODO: check item to be sent out based on route demands
         #TODO: create transport agents
-        self.in_items()
-        self.out_items()
+        # With batch demand the model has already drawn it for all agents
+        if not self.model.batch_demand:
+            self.in_items()
+            self.out_items()
         pass
         
-class SPAgent(Agent):
+class SPAgent(StoreView, Agent):
     """Shop Agent"""
     def __init__(self, unique_id, model):
         super().__init__(unique_id, model)
-        self.products = PROD_SP
         self.type = "SP"
+        self.attach(model)
+        self.products = PROD_SP
         self.demand = 0
         self.next = 0
         self.route = 0
@@ -89,7 +220,7 @@ class SPAgent(Agent):
         p_list[0] = 1
         choice = self.random.choice(p_list)
         if choice ==1:
-            self.demand = round(self.random.gauss(DEM_AV, DEM_SD), 0) 
+            self.demand = round(self.random.gauss(self.model.dem_av, self.model.dem_sd), 0) 
             self.products -= self.demand
         else:
             self.demand = 0
@@ -98,8 +229,10 @@ class SPAgent(Agent):
         # print ("Shop ID " + str(self.unique_id) +"- Products: " + str(self.products))
         #TODO: check if transport item has arrived
         #TODO: reduce amount of item in transport
-        self.in_items()
-        self.out_items()
+        # With batch demand the model has already drawn it for all agents
+        if not self.model.batch_demand:
+            self.in_items()
+            self.out_items()
         pass
 
 class TRAgent(Agent):
@@ -108,7 +241,7 @@ class TRAgent(Agent):
         super().__init__(unique_id, model)
         self.products = 0
         self.type = "TR"
-        self.avg_dist = calculate_avg_dist()
+        self.avg_dist = calculate_avg_dist(problem=model.problem)
         
     def in_items (self):
         # Nothing - created with the max. qty to transport
@@ -122,23 +255,102 @@ class TRAgent(Agent):
         pass
 
 
+class ProfileHook():
+    """
+    Step hook running cProfile during the step(s) it is attached to
+    Prints the top entries or dumps the stats to file (pstats format)
+    """
+    def __init__(self, file=None, sort="cumulative", lines=20):
+        self.profiler = cProfile.Profile()
+        self.file = file
+        self.sort = sort
+        self.lines = lines
+
+    def start (self, model):
+        self.profiler.enable()
+
+    def stop (self, model):
+        self.profiler.disable()
+        if self.file is None:
+            pstats.Stats(self.profiler).sort_stats(self.sort).print_stats(self.lines)
+        else:
+            self.profiler.dump_stats(self.file)
+
+
 class MDVRPModel(Model):
-    def __init__(self, N_DC, N_SP, width, height):
+    def __init__(self, N_DC, N_SP, width, height, export_csv=False, workers=1,
+                 improve=False, time_budget=None, capacity=None, incremental=False,
+                 seed=None, store=False, batch_demand=False, dem_av=DEM_AV, dem_sd=DEM_SD,
+                 record=None, export_bin=None, network_k=None, network_radius=None,
+                 balance=False, cluster_size=None):
+        if incremental and cluster_size is not None:
+            # reroute would insert into (and repair) whole stitched routes
+            raise ValueError("incremental routing does not support cluster_size")
         self.N_DC = N_DC
         self.N_SP = N_SP
+        self.dem_av = dem_av
+        self.dem_sd = dem_sd
         self.width = width
         self.height = height
         self.schedule = RandomActivation(self)
         self.space = ContinuousSpace(width, height, True)
+        # Space size for the solver distances (None if not toroidal)
+        self.torus = (self.space.width, self.space.height) if self.space.torus else None
         self.running = True
         self.step_counter = 0
+        # Own random generator (mesa shares one between models of a class)
+        self.seed = seed
+        self.random = random.Random(seed)
         
-        self.datacollector = DataCollector(
-            model_reporters={"Stock": calculate_stock},
-            agent_reporters={"Products": "products"})
+        # Durations (s) and counters of the last step
+        self.timings = {phase: 0.0 for phase in PHASES}
+        self.counters = {"Agents": 0, "Demand_SP": 0, "Routes": 0, "Arcs": 0, "Route_length": 0.0}
+        # Hooks with start(model) / stop(model) around the next step(s)
+        self.step_hooks = []
+
+        # Timings and counters are collected at the start of the next step
+        model_reporters = {"Stock": calculate_stock}
+        for phase in PHASES:
+            model_reporters["T_" + phase] = partial(get_timing, phase=phase)
+        for counter in self.counters:
+            model_reporters[counter] = partial(get_counter, counter=counter)
+        # record: StepRecorder arguments (dict or True) to stream the data to
+        # chunk files instead of keeping every step in the DataCollector
+        if record:
+            self.recorder = StepRecorder(model_reporters, **(record if isinstance(record, dict) else {}))
+            self.datacollector = None
+        else:
+            self.recorder = None
+            self.datacollector = DataCollector(
+                model_reporters=model_reporters,
+                agent_reporters={"Products": "products"})
         
-        self.solver = HSolver()
+        # The solver works in memory, .csv files are an optional export
+        self.export_csv = export_csv
+        # Binary file with the problem, distances and routes of the last step
+        self.export_bin = export_bin
+        # Sparse network.csv: k nearest neighbours or pairs within radius
+        self.network_k = network_k
+        self.network_radius = network_radius
+        self.solver = HSolver(export_csv, workers, improve, time_budget, capacity=capacity,
+                              balance=balance, cluster_size=cluster_size)
+        self.problem = None
+        self.depot_index = None
         self.routes = None
+        # Distances kept while the agents do not move
+        self.dist_cache = DistanceCache()
+        self.network_written = None
+        self.binary_written = None
+        # Update the previous routes instead of solving every step again
+        self.incremental = incremental
+        # Keep the DC/SP state in an AgentStore (created by initiate)
+        self.use_store = store
+        self.store = None
+        # Draw the demand and supply of all agents at once (generate_demand)
+        self.batch_demand = batch_demand
+        self.rng = None
+        self.dc_agents = []
+        self.sp_agents = []
         
     def initiate(self):
         
@@ -149,9 +361,15 @@ class MDVRPModel(Model):
         self.step_counter = -1
         # Restart routes
         self.routes = None
+        # Start a new run in the recorder
+        if self.recorder is not None:
+            self.recorder.restart()
+        # Restart the agent store
+        self.store = AgentStore(self.N_DC + self.N_SP) if self.use_store else None
         # Delete .csv files
-        del_files_by_pattern(r".csv$")
-        # Clean input.csv, network.csv files
+        if self.export_csv:
+            del_files_by_pattern(r".csv$")
+        # Clean problem (and input.csv file)
         self.generate_problem()
         # self.generate_network()
         
@@ -164,6 +382,12 @@ class MDVRPModel(Model):
             x = self.random.randrange(self.space.width)
             y = self.random.randrange(self.space.height)
             self.space.place_agent(a, (x, y))
+
+        # Spatial index over the DC (they never move)
+        dcs = [a for a in self.schedule.agents if a.type == "DC"]
+        dc_ids = [a.unique_id for a in dcs]
+        dc_pos = [a.pos for a in dcs]
+        self.depot_index = DepotIndex(dc_ids, dc_pos, self.torus)
             
         # Create Shops
         for i in range(self.N_SP):
@@ -175,73 +399,224 @@ class MDVRPModel(Model):
             y = self.random.randrange(self.space.height)
             self.space.place_agent(a, (x, y))
             
+        # Distances of the layout (kept until agents are added, removed or moved)
+        agents = [a for a in self.schedule.agents if a.type in ("DC", "SP")]
+        self.dist_cache.update([a.unique_id for a in agents], [a.pos for a in agents],
+                               self.torus, build=True)
+        self.network_written = None
+        self.binary_written = None
+
+        # Agents and generator for the batch demand
+        self.dc_agents = [a for a in self.schedule.agents if a.type == "DC"]
+        self.sp_agents = [a for a in self.schedule.agents if a.type == "SP"]
+        # Same seed, same demand (independent of the activation order)
+        self.rng = np.random.default_rng(self.seed)
+            
         # Info message:
         print ("New model created with {0} DC and {1} Shops".format(self.N_DC, self.N_SP))
                 
     def step(self):
+        hooks = self.step_hooks
+        self.step_hooks = [hook for hook, once in hooks if not once]
+        for hook, once in hooks:
+            hook.start(self)
+        timings = {phase: 0.0 for phase in PHASES}
+        t_start = perf_counter()
         self.step_counter += 1
         # for agent in self.schedule.agents:
         #     agent.in_items()
         #     agent.out_items()
-        self.datacollector.collect(self)
+        if self.recorder is not None:
+            self.recorder.collect(self)
+        else:
+            self.datacollector.collect(self)
+        t_phase = perf_counter()
+        timings["collect"] = t_phase - t_start
+        if self.batch_demand:
+            self.generate_demand()
         self.schedule.step()
+        timings["schedule"] = perf_counter() - t_phase
+        t_phase = perf_counter()
         self.generate_problem()
-        self.generate_network()
-        dc_sp, dc_sp_pos, outfiles = self.solver.solve_MD_short_demand()
-        self.routes = self.solver.aggregate_VRP(*outfiles)
+        timings["problem"] = perf_counter() - t_phase
+        if self.export_csv:
+            t_phase = perf_counter()
+            self.generate_network()
+            timings["network"] = perf_counter() - t_phase
+        t_phase = perf_counter()
+        if self.incremental and self.routes:
+            # Assignment of the new shops is timed within reroute
+            self.routes = self.solver.reroute(self.problem, self.routes, self.depot_index, timings)
+            timings["route"] = perf_counter() - t_phase - timings["assign"]
+        else:
+            dc_sp, dc_sp_pos, subproblems = self.solver.solve_MD_short_demand(self.problem, self.depot_index)
+            timings["assign"] = perf_counter() - t_phase
+            t_phase = perf_counter()
+            self.routes = self.solver.aggregate_VRP(*subproblems, problem=self.problem)
+            timings["route"] = perf_counter() - t_phase
+        if self.export_bin:
+            t_phase = perf_counter()
+            self.generate_binary()
+            timings["export"] = perf_counter() - t_phase
+        timings["step"] = perf_counter() - t_start
+        self.timings = timings
+        self.count_step()
+        for hook, once in hooks:
+            hook.stop(self)
         print("---- Step: " + str (self.step_counter))
+
+    def close (self):
+        """End of the run: write the last recorded steps and stop the solver pool"""
+        if self.recorder is not None:
+            self.recorder.close()
+        self.solver.close()
+
+    def add_step_hook (self, hook, once=True):
+        """
+        Call hook.start(model) before and hook.stop(model) after the next
+        step (every step if once is False), e.g. model.add_step_hook(ProfileHook())
+        """
+        self.step_hooks.append((hook, once))
+
+    def count_step (self):
+        """Update the counters of the last step"""
+        routes = self.routes or []
+        self.counters = {
+            "Agents": len(self.problem.ids),
+            "Demand_SP": len(self.problem.demand_shops()),
+            "Routes": len(routes),
+            "Arcs": sum(len(route) for route in routes if len(route) > 1),
+            "Route_length": routes_length(self.problem, routes)}
         
+    def generate_demand (self):
+        """
+        Supply of every DC and demand of every SP drawn in one vectorized
+        call each (same distributions as the agents' in_items/out_items)
+        """
+        n_dc = len(self.dc_agents)
+        n_sp = len(self.sp_agents)
+        if n_dc:
+            sup_av, sup_sd = self.dc_agents[0].calc_supply()
+            supply = np.round(self.rng.normal(sup_av, sup_sd, n_dc), 0)
+        else:
+            supply = np.zeros(0)
+        trigger = self.rng.random(n_sp) < DEM_PROB
+        demand = np.where(trigger, np.round(self.rng.normal(self.dem_av, self.dem_sd, n_sp), 0), 0.0)
+        store = self.store
+        if store is not None:
+            # Whole-array update (rows follow the agent creation order)
+            is_dc = store.is_dc
+            store.demand[is_dc] = supply
+            store.products[is_dc] += supply
+            store.demand[~is_dc] = demand
+            store.products[~is_dc] -= demand
+        else:
+            for agent, value in zip(self.dc_agents, supply.tolist()):
+                agent.demand = value
+                agent.products += value
+            for agent, value in zip(self.sp_agents, demand.tolist()):
+                agent.demand = value
+                agent.products -= value
+
     def generate_problem (self):
-        # agent_demand = self.datacollector.get_agent_vars_dataframe()
-        with open('input.csv', 'w', newline='') as csvinput:
-            writer = csv.writer(csvinput)
-            header = ["ID","Type","Xpos","Ypos","Products","Demand"]
-            writer.writerow(header)
-            prev_step = self.step_counter - 1
+        """Build the in-memory problem from the agents (and input.csv if exported)"""
+        prev_step = self.step_counter - 1
+        if self.store is not None:
+            return self.generate_problem_store(prev_step)
+        Node_list = []
+        for agent in self.schedule.agents:
             if prev_step > 0:
-                for agent in self.schedule.agents:
-                    # demand = agent.products - agent_demand.loc[(prev_step, agent.unique_id),"Products"]
-                    # print("{3} current prod: {0}, previous prod: {1}, demand: {2}". format(agent.products, agent_demand.loc[(prev_step, agent.unique_id),"Products"], demand, agent.unique_id))
-                    row = [agent.unique_id, agent.type, agent.pos[0], agent.pos[1], agent.products, agent.demand]
-                    writer.writerow(row)
-            else: # control for step 0 which is not considered in MESA
-                for agent in self.schedule.agents:
-                    if agent.type == "DC":
-                        demand = agent.products - PROD_DC
-                    else:
-                        demand = agent.products - PROD_SP
-                    row = [agent.unique_id, agent.type, agent.pos[0], agent.pos[1], agent.products, demand]
-                    writer.writerow(row)
+                demand = agent.demand
+            # control for step 0 which is not considered in MESA
+            elif agent.type == "DC":
+                demand = agent.products - PROD_DC
+            else:
+                demand = agent.products - PROD_SP
+            node = Node(agent.unique_id, agent.type, agent.pos[0], agent.pos[1], agent.products, demand)
+            Node_list.append(node)
+        self.problem = self.dist_cache.attach(Problem(Node_list, self.torus))
+        if self.export_csv:
+            self.problem.to_csv('input.csv')
+        return self.problem
+
+    def generate_problem_store (self, prev_step):
+        """generate_problem from the AgentStore arrays"""
+        store = self.store
+        if prev_step > 0:
+            demand = store.demand
+        # control for step 0 which is not considered in MESA
+        else:
+            demand = store.products - np.where(store.is_dc, PROD_DC, PROD_SP)
+        problem = Problem.from_arrays(store.ids, store.types, store.pos, store.products,
+                                      demand, self.torus)
+        self.problem = self.dist_cache.attach(problem)
+        if self.export_csv:
+            self.problem.to_csv('input.csv')
+        return self.problem
                     
     def generate_network (self):
+        """Write network.csv from the distance matrix of the current problem"""
+        # Same layout as the last written file: nothing to do
+        written = (self.dist_cache.version, self.network_k, self.network_radius)
+        if written == self.network_written and os.path.exists('network.csv'):
+            return
+        self.network_written = written
+        ids = self.problem.ids.tolist()
+        if self.network_k is not None or self.network_radius is not None:
+            network = self.problem.network(self.network_k, self.network_radius)
+            network.to_csv(ids, 'network.csv')
+            return
+        dist = self.problem.dist.tolist()
         with open('network.csv', 'w', newline='') as csvnetwork:
             writer = csv.writer(csvnetwork)
             header = ["Orig","Dest","Cost","Active"]
             writer.writerow(header)
-            for orig in self.schedule.agents:
-                for dest in self.schedule.agents:
-                    if orig != dest:
-                        dist = self.space.get_distance(orig.pos, dest.pos)
-                        row = [orig.unique_id, dest.unique_id, dist, "Y"]
+            for i, orig in enumerate(ids):
+                for j, dest in enumerate(ids):
+                    if i != j:
+                        row = [orig, dest, dist[i][j], "Y"]
                         writer.writerow(row)
+
+    def generate_binary (self):
+        """Write the problem and routes to export_bin (distances only if the layout changed)"""
+        written = (self.dist_cache.version, self.export_bin)
+        update = written == self.binary_written and os.path.exists(self.export_bin)
+        self.problem.to_binary(self.export_bin, self.routes, update=update)
+        self.binary_written = written
     
 
 # Define the required Functions
 
 def calculate_stock (model):
+    if getattr(model, "store", None) is not None:
+        return model.store.total_products()
     stock = 0
     for agent in model.schedule.agents:
         stock += agent.products
     return stock
 
-def calculate_avg_dist (net_file = 'network.csv'):
+def get_timing (model, phase):
+    return model.timings[phase]
+
+def get_counter (model, counter):
+    return model.counters[counter]
+
+def calculate_avg_dist (net_file = 'network.csv', problem=None, samples=AVG_SAMPLES):
+    """
+    Average distance between nodes: from the problem positions if given
+    (exact, or sampled above samples pairs), else from the network file
+    """
+    if problem is not None:
+        return round(problem.mean_dist(samples), 0)
     with open(net_file, newline='') as network:
         reader = csv.reader(network)
         next(reader, None) # skip header
-        dist = []
+        total = 0.0
+        count = 0
         for path in reader:
-            dist.append(float(path[2]))
-        avg_dist = round(np.mean(dist),0)
+            total += float(path[2])
+            count += 1
+        avg_dist = round(total/count, 0) if count else np.nan
         # print (avg_dist)
     return avg_dist
         
@@ -251,10 +626,11 @@ if __name__ == "__main__":
 
     
     # Single step Run (comment if not used):
-    model = MDVRPModel(2, 10, 250, 250)
+    model = MDVRPModel(2, 10, 250, 250, export_csv=True)
     model.initiate()
     model.step()
-    calculate_avg_dist()
+    model.close()
+    calculate_avg_dist(problem=model.problem)
     
     # Complete Run (comment if not used):
     # model = MDVRPModel(3, 15, 300, 300)
@@ -264,18 +640,8 @@ if __name__ == "__main__":
     # Stock_all = model.datacollector.get_model_vars_dataframe()
     # Stock_all.plot()
     
-    # Batch Run (comment if not used):
-    # fixed_params = {"N_SP": 15,
-    #                 "width": 300,
-    #                 "height": 300}
-    # variable_params = {"N_DC": (3,4)}
-
-    # batch_run = BatchRunner(MDVRPModel,
-    #                         variable_params,
-    #                         fixed_params,
-    #                         iterations=5,
-    #                         max_steps=100,
-    #                         model_reporters={"Stock": calculate_stock})
-    # batch_run.run_all()
-    # run_data = batch_run.get_model_vars_dataframe()
-    # plt.scatter(run_data.N_DC, run_data.Stock)
+    # Batch Run (comment if not used, see experiments.py):
+    # from experiments import param_grid, run_batch
+    # runs = param_grid(N_DC=(3,4), N_SP=(15,), size=(300,), seed=range(5))
+    # run_data = run_batch(runs, steps=100)
+    # plt.scatter([run["N_DC"] for run in run_data], [run["Stock_end"] for run in run_data])
@@ -1,4 +1,4 @@
-from tkinter import Tk, Button, Menu, Label, StringVar, messagebox
+from tkinter import Tk, Button, Menu, Label, StringVar, Canvas, messagebox
 from PIL import ImageTk, Image
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -11,27 +11,161 @@ from AB_VRP import *
 from svglib.svglib import svg2rlg
 from reportlab.graphics import renderPM
 
-from threading import Thread
+from threading import Thread, Event
+from queue import Queue, Empty, Full
+from collections import namedtuple, deque
 from time import sleep
 
 
 # Define the required Parameters
 PLTSIZE = (3, 2)    # Plot Size (width, height)
 DPI = 100           # Plot Dots Per Inch (default = 100)
+PLT_MAX = 1000      # Plot points kept (most recent steps)
 IMG_X = 1           # Space (agents) Image X position (column)
 IMG_Y = 2           # Space (agents) Image Y position (row)
 PLT_X = 2           # Plot X position (column)
 PLT_Y = 2           # Plot Y position (row)
-FRQ_STP = 0.2       # Step frequency
+FRQ_STP = 0.0       # Minimum time between simulation steps (s, 0: full speed)
+FRQ_DRW = 50        # GUI refresh period (ms)
+FRM_QUE = 2         # Frames waiting for the GUI (older frames are dropped)
 
 N_DC = 3            # Number of DC Agents (Depot Center)
 N_SP = 15           # Number of SP Agents (Shops)
 MDL_X = 300         # Model Width
 MDL_Y = 300         # Model Height
+MDL_REC = {"ring": PLT_MAX}     # StepRecorder arguments (None: DataCollector)
 
 
 # Define the required Classes
 
+# Immutable snapshot of the model for the GUI
+# agents: (unique_id, x, y, products) per agent
+# routes: closed route positions (x0, y0, x1, y1, ..., x0, y0) per route
+Frame = namedtuple("Frame", ["step", "agents", "routes"])
+
+class CanvasRenderer():
+    """
+    Draws the agents and routes (as draw_VRP_sol) on a persistent Tk Canvas
+    The canvas items are created once and then moved / recoloured in place
+    """
+    def __init__(self, master, width, height, tk_column, tk_row):
+        self.canvas = Canvas(master, width=width+2*SPC_PAD, height=height+2*SPC_PAD, bg="white")
+        self.canvas.grid(column=tk_column, row=tk_row)
+        # unique_id: (circle, ID text, products text)
+        self.agent_items = {}
+        self.route_items = []
+
+    def clear (self):
+        self.canvas.delete("all")
+        self.agent_items = {}
+        self.route_items = []
+
+    def draw (self, Model, routes=None):
+        self.draw_frame(make_frame(Model, routes))
+
+    def draw_frame (self, frame):
+        self.draw_routes(frame.routes)
+        self.draw_agents(frame.agents)
+
+    def draw_routes (self, routes):
+        canvas = self.canvas
+        for r, route in enumerate(routes):
+            coords = [value+SPC_PAD for value in route]
+            if r < len(self.route_items):
+                canvas.coords(self.route_items[r], *coords)
+            else:
+                item = canvas.create_line(*coords, fill="#C0C0C0", width=2, tags="route")
+                self.route_items.append(item)
+        # Remove the lines of routes that no longer exist
+        for item in self.route_items[len(routes):]:
+            canvas.delete(item)
+        del self.route_items[len(routes):]
+        canvas.tag_lower("route")
+
+    def draw_agents (self, agents):
+        canvas = self.canvas
+        current = set()
+        for unique_id, x, y, products in agents:
+            current.add(unique_id)
+            x += SPC_PAD
+            y += SPC_PAD
+            color = "green" if products > 0 else "red"
+            items = self.agent_items.get(unique_id)
+            if items is None:
+                fill = "red" if unique_id < 1000 else "blue"
+                items = (canvas.create_oval(x-AGENT_R, y-AGENT_R, x+AGENT_R, y+AGENT_R,
+                                            fill=fill, outline=""),
+                         canvas.create_text(x, y, text=unique_id, anchor="sw"),
+                         canvas.create_text(x, y+10, anchor="sw"))
+                self.agent_items[unique_id] = items
+            else:
+                canvas.coords(items[0], x-AGENT_R, y-AGENT_R, x+AGENT_R, y+AGENT_R)
+                canvas.coords(items[1], x, y)
+                canvas.coords(items[2], x, y+10)
+            canvas.itemconfigure(items[2], text=products, fill=color)
+        # Remove the agents that no longer exist
+        for unique_id in set(self.agent_items) - current:
+            for item in self.agent_items.pop(unique_id):
+                canvas.delete(item)
+
+
+class LivePlot():
+    """
+    Stock plot kept on one Figure/Tk widget: new points are appended to the
+    line and only the axes area is blitted; the axes are rescaled (full
+    redraw) only when a point falls outside them. Keeps the last size points
+    """
+    def __init__(self, master, tk_column, tk_row, size=PLT_MAX):
+        self.fig = Figure(figsize=PLTSIZE, dpi=DPI)
+        self.ax = self.fig.add_subplot()
+        self.line, = self.ax.plot([], [], animated=True)
+        self.steps = deque(maxlen=size)
+        self.values = deque(maxlen=size)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=master)
+        self.canvas.get_tk_widget().grid(column=tk_column, row=tk_row)
+        self.background = None
+        # full redraws (rescale, window resize) capture a new background
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.canvas.draw()
+
+    def on_draw (self, event):
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.line)
+
+    def clear (self):
+        self.steps.clear()
+        self.values.clear()
+        self.line.set_data([], [])
+        self.canvas.draw()
+
+    def add (self, points):
+        """Append (step, value) points and update the plot"""
+        points = list(points)
+        if not points:
+            return
+        for step, value in points:
+            self.steps.append(step)
+            self.values.append(value)
+        self.line.set_data(self.steps, self.values)
+        x0, x1 = self.ax.get_xlim()
+        y0, y1 = self.ax.get_ylim()
+        inside = all(x0 <= step <= x1 and y0 <= value <= y1 for step, value in points)
+        if not inside or self.background is None:
+            self.rescale()
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.bbox)
+
+    def rescale (self):
+        # room ahead so that the next points fit without a redraw
+        first, last = self.steps[0], self.steps[-1]
+        self.ax.set_xlim(first, last + max(10, last - first))
+        low, high = min(self.values), max(self.values)
+        pad = max(1, (high - low) / 2)
+        self.ax.set_ylim(low - pad, high + pad)
+
 
 # Define the required Functions
 
@@ -55,62 +189,113 @@ def display_img (image_in, tk_column, tk_row):
     img_panel.grid(column=tk_column, row=tk_row)
     return img_panel
 
-def update_plot (model, tk_column, tk_row):
-    fig = Figure(figsize=PLTSIZE, dpi=DPI)
-    stock = plot_Model_values(model)
-    fig.add_subplot().plot(stock)
-    canvas = FigureCanvasTkAgg(fig, master=root)
-    canvas.draw()
-    canvas.get_tk_widget().grid(column=tk_column, row=tk_row)
+def make_frame (Model, routes=None):
+    """Snapshot of the agents and routes of Model (taken in the simulation thread)"""
+    agents = tuple((agent.unique_id, agent.pos[0], agent.pos[1], agent.products)
+                   for agent in Model.schedule.agents)
+    trips = tuple(trip if len(trip) >= 4 else trip + trip
+                  for trip in route_geometry(Model, routes).coords)
+    return Frame(Model.step_counter, agents, trips)
+
+def new_stock_points (model, last):
+    """
+    (step, stock) collected after step last: the "Stock" model variable
+    (taken at the start of the step) of the recorder or the DataCollector
+    """
+    if model.recorder is not None:
+        return model.recorder.recent_since(last, "Stock")
+    if model.step_counter > last:
+        return [(model.step_counter, model.datacollector.model_vars["Stock"][-1])]
+    return []
+
+def publish (model):
+    """
+    Queue a frame of model for the GUI (dropping the oldest if full) and
+    its stock points not published yet
+    """
+    global stock_last
+    points = new_stock_points(model, stock_last)
+    if points:
+        stock_points.extend(points)
+        stock_last = points[-1][0]
+    frame = make_frame(model, model.routes)
+    while True:
+        try:
+            frames.put_nowait(frame)
+            return
+        except Full:
+            try:
+                frames.get_nowait()
+            except Empty:
+                pass
+
+def poll_frames ():
+    """Draw the latest frame (skipping stale ones); runs in the Tk main loop"""
+    frame = None
+    while True:
+        try:
+            frame = frames.get_nowait()
+        except Empty:
+            break
+    if frame is not None:
+        renderer.draw_frame(frame)
+        step_counter.set("Step: " + str(frame.step))
+        # stock points are published before their frame
+        points = []
+        while stock_points:
+            points.append(stock_points.popleft())
+        live_plot.add(points)
+    root.after(FRQ_DRW, poll_frames)
 
 def reset_model (model):
+    global stock_last
     model.initiate()
-    img = create_img(model, model.routes)
-    display_img(img, IMG_X, IMG_Y)
-    update_plot(model, PLT_X, PLT_Y)
-    step_counter.set("Step: " + str(model.step_counter))
+    stock_last = -1
+    renderer.clear()
+    stock_points.clear()
+    live_plot.clear()
+    publish(model)
     print("Model reset. Running: " + str(running))
     return model
     
 def step_model ():
     model.step()
-    img = create_img(model, model.routes)
-    display_img(img, IMG_X, IMG_Y)
-    update_plot(model, PLT_X, PLT_Y)
-    step_counter.set("Step: " + str(model.step_counter))
+    publish(model)
 
 def running_model():
-    global running
-    while True:
+    # Simulation thread: never touches the Tk widgets
+    while not stop_event.is_set():
         step_model()
-        step_counter.set("Step: " + str(model.step_counter))
-        sleep(FRQ_STP)
-        if running == False:
-            break
+        if FRQ_STP:
+            sleep(FRQ_STP)
 
 def play_stop_model ():
-    global running
+    global running, run_thread
     running = not running
     if running:
         print("Running Model. Running: " + str(running))
         B1["text"] = "Stop"
         B2["state"] = "disabled"
+        B3["state"] = "disabled"
+        stop_event.clear()
         run_thread=Thread(target=running_model, daemon=True)
         run_thread.start()
-        running = True
         return running
     else:
         print ("Model Stopped. Running: " + str(running))
+        stop_event.set()
+        # wait for the step in progress
+        run_thread.join()
         B1["text"] = "Play"
         B2["state"] = "normal"
-        running = False
+        B3["state"] = "normal"
         return running
     
 def on_closing():
-    global running
-    running = False
-    B1["text"] = "Play"
+    if running:
+        play_stop_model()
     if messagebox.askokcancel("Quit", "Do you want to quit?"):
+        model.close()
         root.destroy()
         
 
@@ -118,11 +303,17 @@ def on_closing():
 
 if __name__ == "__main__":
     
-    model = MDVRPModel(N_DC, N_SP, MDL_X, MDL_Y)
+    model = MDVRPModel(N_DC, N_SP, MDL_X, MDL_Y, record=MDL_REC)
     model.initiate()
     
     global running
     running = False
+    run_thread = None
+    stop_event = Event()
+    # Simulation -> GUI: latest frames and stock points
+    frames = Queue(maxsize=FRM_QUE)
+    stock_points = deque()
+    stock_last = -1
     
     print("Model started. Running: " + str(running))
 
@@ -155,12 +346,12 @@ if __name__ == "__main__":
     TemplateMenu.add_command(label="About", command=dummy_message)
     MenuBar.add_cascade(label="Info", menu=TemplateMenu)
     
-    #Insert Image
-    image_agents = create_img(model, model.routes)
-    img_panel = display_img(image_agents, IMG_X, IMG_Y)
+    #Insert Image (create_img/display_img: SVG export path)
+    renderer = CanvasRenderer(root, MDL_X, MDL_Y, IMG_X, IMG_Y)
+    renderer.draw(model, model.routes)
     
     #Insert Plot
-    update_plot(model, PLT_X, PLT_Y)
+    live_plot = LivePlot(root, PLT_X, PLT_Y)
 
     #Insert Step Counter
     step_counter = StringVar(root)
@@ -168,6 +359,9 @@ if __name__ == "__main__":
     step_counter.set("Step: -")
     Stp_ctr.grid(column=1, row=1)
 
+    #Draw the frames published by the simulation
+    root.after(FRQ_DRW, poll_frames)
+
     #End
     root.protocol("WM_DELETE_WINDOW", on_closing)
     root.mainloop()
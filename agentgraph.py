@@ -7,6 +7,59 @@ from hsolver import HSolver
 SPC_PAD = 20    # Padding around model space (for visualization only)
 AGENT_R = 5     # Agent Display Radius
 
+
+class RouteGeometry ():
+    """
+    Drawing positions shared by the draw functions: unique_id -> position
+    (rebuilt when the agent layout changes) and the arcs of every route
+    (recomputed only for the routes that changed since the last frame)
+    """
+    def __init__(self):
+        self.pos = {}
+        self.layout = None
+        self.routes = []
+        self.arcs = []
+        self.coords = []
+
+    def update (self, Model, routes=None):
+        # Layout version of the model distance cache (else always rebuilt)
+        cache = getattr(Model, "dist_cache", None)
+        layout = (cache.version, len(Model.schedule.agents)) if cache is not None else None
+        rebuilt = layout is None or layout != self.layout
+        if rebuilt:
+            self.pos = {agent.unique_id: agent.pos for agent in Model.schedule.agents}
+            self.layout = layout
+        routes = routes or []
+        for r, route in enumerate(routes):
+            route = tuple(int(stop) for stop in route)
+            if not rebuilt and r < len(self.routes) and self.routes[r] == route:
+                continue
+            # closed trip: back to the depot
+            trip = [self.pos[stop] for stop in route] + [self.pos[route[0]]]
+            arcs = list(zip(trip[:-1], trip[1:]))
+            coords = tuple(value for pos in trip for value in pos)
+            if r < len(self.routes):
+                self.routes[r] = route
+                self.arcs[r] = arcs
+                self.coords[r] = coords
+            else:
+                self.routes.append(route)
+                self.arcs.append(arcs)
+                self.coords.append(coords)
+        del self.routes[len(routes):]
+        del self.arcs[len(routes):]
+        del self.coords[len(routes):]
+        return self
+
+
+def route_geometry (Model, routes=None):
+    """RouteGeometry of Model (kept on the model between frames), updated for routes"""
+    geometry = getattr(Model, "route_geometry", None)
+    if geometry is None:
+        geometry = RouteGeometry()
+        Model.route_geometry = geometry
+    return geometry.update(Model, routes)
+
 def draw_Agents_simple (Model):
     dwg = svgwrite.Drawing('img.svg', profile='tiny')
     dwg.viewbox(-SPC_PAD, -SPC_PAD, Model.width+2*SPC_PAD, Model.height+2*SPC_PAD)
@@ -68,34 +121,8 @@ def draw_VRP_sol (Model, routes=None):
         dwg = svgwrite.Drawing('img.svg', profile='tiny')
         dwg.viewbox(-SPC_PAD, -SPC_PAD, Model.width+2*SPC_PAD, Model.height+2*SPC_PAD)
         
-        map_trip = []
-        for dc in range(len(routes)):
-            trip = []
-            for sp in range(len(routes[dc])):
-                # print (type(routes[dc][sp]))
-                for agent in Model.schedule.agents:
-                    # print(type(agent.unique_id))
-                    if int(agent.unique_id) == int(routes[dc][sp]):
-                        if agent.unique_id < 1000:
-                            dc_pos = agent.pos
-                        # print("found {0} and {1}".format(agent.unique_id, routes[dc][sp]))
-                        trip.append(agent.pos)
-            trip.append(dc_pos)
-            map_trip.append(trip)
-        
-        # Convert in arcs instead of positions:
-        map_trip_arcs = []
-        for trip in map_trip:
-            trip_arcs = []
-            count = 0
-            for pos in trip:
-                if count == 0:
-                    prev_pos = pos
-                    count +=1
-                else:
-                    trip_arcs.append((prev_pos,pos))
-                    prev_pos = pos
-            map_trip_arcs.append(trip_arcs)
+        # Arcs of the routes (recomputed only for changed routes)
+        map_trip_arcs = route_geometry(Model, routes).arcs
         
         # Draw the trip arcs:        
         for trip in map_trip_arcs:
@@ -114,7 +141,7 @@ def draw_VRP_sol (Model, routes=None):
     return dwg
 
 if __name__ == "__main__":
-    model = MDVRPModel(3, 10, 250, 250)
+    model = MDVRPModel(3, 10, 250, 250, export_csv=True)
     model.initiate()
     model.step()
     solver = HSolver()
@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+import csv
+import io
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+from hsolver import *
+
+
+# Define the required Parameters
+
+GREEDY_SIZES = (100, 1000, 10000)   # Stops per depot for the greedy benchmark
+LS_SIZE = 2000                      # Stops per depot for the local search benchmark
+LS_BUDGETS = (0.01, 0.05, 0.2, 1)   # Local search time budgets (s)
+SPC_SIZE = 1000                     # Width and height of the random instances
+SEED = 0                            # Seed for the random instances
+
+GRID_DC = (3, 10)                   # N_DC values for the pipeline benchmark
+GRID_SP = (100, 1000)               # N_SP values for the pipeline benchmark
+GRID_STEPS = (10,)                  # Step counts for the pipeline benchmark
+GRID_SEEDS = (0, 1)                 # Model seeds for the pipeline benchmark
+BENCH_OUT = "benchmark.csv"         # Pipeline benchmark results file
+
+# Timed stages of MDVRPModel.step (in order)
+STAGES = ["schedule.step", "generate_problem", "generate_network",
+          "solve_MD_short_demand", "aggregate_VRP", "render"]
+
+
+# Define the required Functions
+
+def random_vrp (n_stops, size=SPC_SIZE, seed=SEED):
+    """Single depot sub-problem with n_stops random shops"""
+    rng = np.random.default_rng(seed)
+    pos = rng.integers(0, size, (n_stops+1, 2))
+    Node_list = [Node(0, "DC", int(pos[0][0]), int(pos[0][1]), 0, 0)]
+    for i in range(1, n_stops+1):
+        Node_list.append(Node(1000+i, "SP", int(pos[i][0]), int(pos[i][1]), 0, 1))
+    return Problem(Node_list, (size, size))
+
+def greedy_list_route (vrp):
+    """Previous list-based nearest neighbour (reference for the benchmark)"""
+    candidates = list(vrp.Node_list)
+    route = [candidates[0].ID]
+    while len(candidates) > 1:
+        dist_min = np.inf
+        pos1 = (candidates[0].Xpos,candidates[0].Ypos)
+        candidates.pop(0)
+        next_n = []
+        for node in candidates:
+            pos2 = (node.Xpos,node.Ypos)
+            dist = calc_dist(pos1, pos2, vrp.torus)
+            if dist < dist_min:
+                dist_min = dist
+                next_n = node
+        i = candidates.index(next_n)
+        candidates.pop(i)
+        candidates.insert(0, next_n)
+        route.append(next_n.ID)
+    return route
+
+def bench_greedy (sizes=GREEDY_SIZES, reference=True):
+    """Time solve_VRP_greedy against the list-based reference"""
+    solver = HSolver()
+    results = []
+    for n_stops in sizes:
+        vrp = random_vrp(n_stops)
+        start = time.perf_counter()
+        route = solver.solve_VRP_greedy(vrp)
+        t_new = time.perf_counter() - start
+        t_ref = None
+        if reference:
+            start = time.perf_counter()
+            route_ref = greedy_list_route(vrp)
+            t_ref = time.perf_counter() - start
+            assert route == route_ref, "routes differ for {0} stops".format(n_stops)
+        results.append((n_stops, t_new, t_ref))
+        if t_ref is None:
+            print("{0:>6} stops: greedy {1:.4f} s".format(n_stops, t_new))
+        else:
+            info = [n_stops, t_new, t_ref, t_ref/t_new]
+            print("{0:>6} stops: greedy {1:.4f} s, list-based {2:.4f} s ({3:.1f}x)".format(*info))
+    return results
+
+def bench_local_search (n_stops=LS_SIZE, budgets=LS_BUDGETS):
+    """Route length after 2-opt/Or-opt for several time budgets"""
+    vrp = random_vrp(n_stops)
+    order = nearest_neighbour_order(vrp)
+    length_nn = route_length(vrp.dist, order)
+    print("{0:>6} stops: greedy length {1:.0f}".format(n_stops, length_nn))
+    results = []
+    for budget in budgets:
+        start = time.perf_counter()
+        ls = LocalSearch(vrp.dist, pos=vrp.pos, torus=vrp.torus)
+        improved = ls.improve(order, time_budget=budget, start=start)
+        t_ls = time.perf_counter() - start
+        length = route_length(vrp.dist, improved)
+        results.append((budget, t_ls, length))
+        info = [budget, t_ls, length, 100*(length_nn-length)/length_nn]
+        print("  budget {0:>5} s: {1:.4f} s, length {2:.0f} (-{3:.1f}%)".format(*info))
+    return results
+
+def git_revision ():
+    """Short hash of the current revision ("unknown" outside git)"""
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                             text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def timed (func, timings, stage):
+    """Wrap func so that its run time is added to timings[stage]"""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] += time.perf_counter() - start
+        return result
+    return wrapper
+
+def run_pipeline (n_dc, n_sp, steps, seed, size=SPC_SIZE, export_csv=True, render=True):
+    """
+    Run MDVRPModel for steps and return the total time (s) per stage
+    Runs in a temporary folder so .csv/.svg files do not collide
+    """
+    from AB_VRP import MDVRPModel
+    timings = {stage: 0.0 for stage in STAGES}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(tmp)
+        try:
+            model = MDVRPModel(n_dc, n_sp, size, size, export_csv=export_csv, seed=seed)
+            model.initiate()
+            # Time the stages called by model.step
+            model.schedule.step = timed(model.schedule.step, timings, "schedule.step")
+            model.generate_problem = timed(model.generate_problem, timings, "generate_problem")
+            model.generate_network = timed(model.generate_network, timings, "generate_network")
+            solver = model.solver
+            solver.solve_MD_short_demand = timed(solver.solve_MD_short_demand, timings,
+                                                 "solve_MD_short_demand")
+            solver.aggregate_VRP = timed(solver.aggregate_VRP, timings, "aggregate_VRP")
+            if render:
+                from agentgraph import draw_VRP_sol
+            start = time.perf_counter()
+            for i in range(steps):
+                model.step()
+                if render:
+                    t_render = time.perf_counter()
+                    draw_VRP_sol(model, model.routes).tostring()
+                    timings["render"] += time.perf_counter() - t_render
+            model.close()
+            timings["total"] = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    return timings
+
+def bench_pipeline (grid_dc=GRID_DC, grid_sp=GRID_SP, grid_steps=GRID_STEPS, seeds=GRID_SEEDS,
+                    out_f=BENCH_OUT, export_csv=True, render=True):
+    """
+    Time every stage of the simulate-assign-route pipeline over a grid
+    of N_DC, N_SP, steps and seeds; one row per run and stage in out_f
+    """
+    revision = git_revision()
+    rows = []
+    for n_dc in grid_dc:
+        for n_sp in grid_sp:
+            for steps in grid_steps:
+                for seed in seeds:
+                    timings = run_pipeline(n_dc, n_sp, steps, seed, export_csv=export_csv,
+                                           render=render)
+                    for stage, total in timings.items():
+                        rows.append([revision, n_dc, n_sp, steps, seed, stage, total, total/steps])
+                    info = [n_dc, n_sp, steps, seed, timings["total"]]
+                    print("DC {0:>4}, SP {1:>6}, steps {2:>4}, seed {3}: {4:.3f} s".format(*info))
+    with open(out_f, 'w', newline='') as csvoutput:
+        writer = csv.writer(csvoutput)
+        header = ["Revision", "N_DC", "N_SP", "Steps", "Seed", "Stage", "Total", "Per_step"]
+        writer.writerow(header)
+        writer.writerows(rows)
+    return rows
+
+def compare_results (old_f, new_f):
+    """Print the per step time ratio (new/old) of every configuration and stage"""
+    def load(file):
+        times = {}
+        with open(file, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                key = (int(row["N_DC"]), int(row["N_SP"]), int(row["Steps"]), row["Stage"])
+                times.setdefault(key, []).append(float(row["Per_step"]))
+        return {key: np.mean(value) for key, value in times.items()}
+    old = load(old_f)
+    new = load(new_f)
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key] if old[key] > 0 else np.nan
+        info = list(key) + [old[key], new[key], ratio]
+        print("DC {0:>4}, SP {1:>6}, steps {2:>4}, {3:<22} {4:.5f} -> {5:.5f} s ({6:.2f}x)".format(*info))
+
+
+# Main program execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AB_VRP benchmarks")
+    parser.add_argument("--dc", type=int, nargs="+", default=GRID_DC)
+    parser.add_argument("--sp", type=int, nargs="+", default=GRID_SP)
+    parser.add_argument("--steps", type=int, nargs="+", default=GRID_STEPS)
+    parser.add_argument("--seeds", type=int, nargs="+", default=GRID_SEEDS)
+    parser.add_argument("--out", default=BENCH_OUT)
+    parser.add_argument("--no-csv", action="store_true", help="do not export the .csv files")
+    parser.add_argument("--no-render", action="store_true", help="do not time the rendering")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--heuristics", action="store_true",
+                        help="run the greedy and local search benchmarks")
+    args = parser.parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+    elif args.heuristics:
+        bench_greedy()
+        bench_local_search()
+    else:
+        bench_pipeline(args.dc, args.sp, args.steps, args.seeds, args.out,
+                       not args.no_csv, not args.no_render)
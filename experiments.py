@@ -0,0 +1,131 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from AB_VRP import *
+
+
+# Define the required Parameters
+
+SWEEP_DC = (3, 4)                   # N_DC values of the default sweep
+SWEEP_SP = (15,)                    # N_SP values of the default sweep
+SWEEP_SIZE = (300,)                 # Width and height values of the default sweep
+SWEEP_SEEDS = (0, 1, 2, 3, 4)       # Model seeds of the default sweep
+SWEEP_STEPS = 100                   # Steps per run
+SWEEP_OUT = "experiments.csv"       # Aggregate results file (one row per run)
+
+# Per run results (after the run parameters)
+RESULTS = ["Steps", "Stock_end", "Stock_mean", "Demand_SP_mean", "Routes_mean",
+           "Route_length_mean", "Time"]
+
+
+# Define the required Functions
+
+def param_grid (**values):
+    """
+    Runs of a sweep: every combination of the given values, e.g.
+    param_grid(N_DC=(3, 4), N_SP=(15,), seed=range(5))
+    """
+    keys = list(values)
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values.values())]
+
+def run_experiment (params, steps=SWEEP_STEPS, options=None):
+    """
+    Run one MDVRPModel headless and return params with its aggregate results
+    params: MDVRPModel arguments (size sets width and height)
+    options: MDVRPModel arguments shared by all runs
+    The run works in its own temporary folder, so exported .csv files
+    (and initiate deleting them) do not touch other runs
+    """
+    kwargs = dict(options or {})
+    kwargs.update(params)
+    size = kwargs.pop("size", None)
+    if size is not None:
+        kwargs["width"] = kwargs["height"] = size
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            model = MDVRPModel(**kwargs)
+            model.initiate()
+            stock = []
+            counters = []
+            for i in range(steps):
+                model.step()
+                stock.append(calculate_stock(model))
+                counters.append(model.counters)
+            model.close()
+            t_run = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+    result = dict(params)
+    result.update({
+        "Steps": steps,
+        "Stock_end": stock[-1] if stock else np.nan,
+        "Stock_mean": np.mean(stock) if stock else np.nan,
+        "Demand_SP_mean": np.mean([c["Demand_SP"] for c in counters]) if counters else np.nan,
+        "Routes_mean": np.mean([c["Routes"] for c in counters]) if counters else np.nan,
+        "Route_length_mean": np.mean([c["Route_length"] for c in counters]) if counters else np.nan,
+        "Time": t_run})
+    return result
+
+def run_batch (runs, steps=SWEEP_STEPS, options=None, workers=None, out_f=SWEEP_OUT):
+    """
+    Run every parameter set of runs (see param_grid) on a process pool
+    (workers=1 runs them in this process). Each result row is written to
+    out_f as soon as its run finishes; returns the rows in completion order
+    """
+    runs = list(runs)
+    keys = []
+    for params in runs:
+        keys += [key for key in params if key not in keys]
+    header = keys + RESULTS
+    rows = []
+    with open(out_f, 'w', newline='') as csvoutput:
+        writer = csv.DictWriter(csvoutput, header, restval="")
+        writer.writeheader()
+        def record(result):
+            writer.writerow(result)
+            csvoutput.flush()
+            rows.append(result)
+            info = [len(rows), len(runs), result["Time"]]
+            print("Run {0}/{1} done in {2:.2f} s".format(*info))
+        if workers == 1:
+            for params in runs:
+                record(run_experiment(params, steps, options))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_experiment, params, steps, options)
+                           for params in runs]
+                for future in as_completed(futures):
+                    record(future.result())
+    return rows
+
+
+# Main program execution
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AB_VRP headless parameter sweeps")
+    parser.add_argument("--dc", type=int, nargs="+", default=SWEEP_DC)
+    parser.add_argument("--sp", type=int, nargs="+", default=SWEEP_SP)
+    parser.add_argument("--size", type=int, nargs="+", default=SWEEP_SIZE)
+    parser.add_argument("--dem-av", type=float, nargs="+", default=(DEM_AV,))
+    parser.add_argument("--dem-sd", type=float, nargs="+", default=(DEM_SD,))
+    parser.add_argument("--seeds", type=int, nargs="+", default=SWEEP_SEEDS)
+    parser.add_argument("--steps", type=int, default=SWEEP_STEPS)
+    parser.add_argument("--workers", type=int, default=None, help="processes (default: all cores)")
+    parser.add_argument("--out", default=SWEEP_OUT)
+    parser.add_argument("--batch-demand", action="store_true", help="vectorized demand generation")
+    parser.add_argument("--store", action="store_true", help="columnar agent state")
+    args = parser.parse_args()
+    runs = param_grid(N_DC=args.dc, N_SP=args.sp, size=args.size, dem_av=args.dem_av,
+                      dem_sd=args.dem_sd, seed=args.seeds)
+    options = {"batch_demand": args.batch_demand, "store": args.store}
+    run_batch(runs, args.steps, options, args.workers, args.out)
@@ -1,9 +1,39 @@
 import csv
 import numpy as np
 from itertools import tee
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from time import perf_counter
+import heapq
 import os
 import re
 
+try:
+    from scipy.spatial import cKDTree
+except ImportError: # optional: brute force (vectorized) nearest depot search
+    cKDTree = None
+
+
+# Define the required Parameters
+
+BIN_MAGIC = b"ABVRPBIN"     # Signature of the binary problem/solution files
+BIN_VERSION = 1             # Binary format version (checked on read)
+BIN_ALIGN = 64              # Byte alignment of the arrays in the binary files
+
+# Binary file header (offsets in bytes from the start of the file)
+BIN_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("flags", "<u4"),
+                       ("n_nodes", "<u8"), ("n_routes", "<u8"), ("n_stops", "<u8"),
+                       ("torus", "<f8", 2), ("node_off", "<u8"), ("dist_off", "<u8"),
+                       ("route_off", "<u8"), ("stop_off", "<u8")])
+# Node table row (Type: 0 = DC, 1 = SP)
+BIN_NODE = np.dtype([("ID", "<i8"), ("Type", "u1"), ("Xpos", "<f8"), ("Ypos", "<f8"),
+                     ("Products", "<f8"), ("Demand", "<f8")])
+BALANCE_K = 4               # Nearest depots considered by the balanced assignment
+DIST_CACHE_MAX = 2000       # Nodes up to which DistanceCache keeps the full matrix
+
+BIN_DIST = 1                # Header flag: the distance matrix is stored
+BIN_ROUTES = 2              # Header flag: the routes are stored
+
 
 # Define the required Classes
 
@@ -40,10 +70,653 @@ class Arc ():
         print("Arc from ID {0} to ID {1}. Cost is: {2}".format(*info))
 
 
+class NodeRegistry ():
+    """Hash indexes over a node list: by ID, by position and by array index"""
+    def __init__(self, Node_list):
+        self.Node_list = Node_list
+        self.by_id = {}
+        self.by_pos = {}
+        self.index = {}
+        for i, node in enumerate(Node_list):
+            self.by_id[node.ID] = node
+            self.index[node.ID] = i
+            # last node wins for shared positions (as the old coordinate scan)
+            self.by_pos[(node.Xpos, node.Ypos)] = node
+
+    def find (self, ID):
+        return self.by_id.get(ID)
+
+    def find_by_pos (self, pos):
+        return self.by_pos.get(tuple(pos))
+
+    def index_of (self, ID):
+        """Row of the node in the problem arrays (pos, dist)"""
+        return self.index[ID]
+
+
+class DepotIndex ():
+    """
+    Spatial index over depot positions for batch nearest depot queries
+    KD-tree if scipy is installed, chunked NumPy brute force otherwise
+    Built once per model, since depots never move
+    """
+    def __init__(self, ids, pos, torus=None, chunk=4096):
+        self.ids = list(ids)
+        self.pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        self.torus = torus
+        self.chunk = chunk
+        self.tree = None
+        if cKDTree is not None and len(self.ids) > 0:
+            if torus is None:
+                self.tree = cKDTree(self.pos)
+            else:
+                self.tree = cKDTree(np.mod(self.pos, torus), boxsize=torus)
+
+    def query (self, pos, k=1):
+        """
+        Distances and indices (into self.ids) of the k nearest depots
+        for every position; both arrays have shape (len(pos), k)
+        """
+        pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        k = min(k, len(self.ids))
+        if len(pos) == 0 or k == 0:
+            return np.empty((len(pos), k)), np.empty((len(pos), k), dtype=int)
+        if self.tree is not None:
+            if self.torus is not None:
+                pos = np.mod(pos, self.torus)
+            dist, idx = self.tree.query(pos, k=k)
+            return dist.reshape(-1, k), idx.reshape(-1, k)
+        dist = np.empty((len(pos), k))
+        idx = np.empty((len(pos), k), dtype=int)
+        for start in range(0, len(pos), self.chunk):
+            end = start + self.chunk
+            d = calc_dist_matrix(pos[start:end], self.pos, self.torus)
+            if k == 1:
+                near = np.argmin(d, axis=1)[:, np.newaxis]
+            else:
+                near = np.argpartition(d, k-1, axis=1)[:, :k]
+                # order the k nearest by distance (then depot order)
+                order = np.lexsort((near, np.take_along_axis(d, near, axis=1)))
+                near = np.take_along_axis(near, order, axis=1)
+            idx[start:end] = near
+            dist[start:end] = np.take_along_axis(d, near, axis=1)
+        return dist, idx
+
+    def nearest (self, pos):
+        """Index (into self.ids) of the nearest depot for every position"""
+        return self.query(pos, k=1)[1][:, 0]
+
+
+class SparseNetwork ():
+    """
+    Sparse network over node positions: the k nearest neighbours of every
+    node, or the nodes within radius, as CSR arrays (row i: indices and
+    distances data[indptr[i]:indptr[i+1]], sorted by index). Used for the
+    sparse network.csv export only, the heuristics work on the distances
+    """
+    def __init__(self, pos, k=None, radius=None, torus=None, chunk=4096):
+        self.pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        self.torus = torus
+        self.k = k
+        self.radius = radius
+        n = len(self.pos)
+        rows = np.arange(n)
+        if k is None and radius is None:
+            raise ValueError("SparseNetwork needs k or radius")
+        if n == 0:
+            self.indptr = np.zeros(1, dtype=int)
+            self.indices = np.empty(0, dtype=int)
+        elif k is not None:
+            k = max(min(k, n-1), 0)
+            _, idx = DepotIndex(rows, self.pos, torus, chunk).query(self.pos, k+1)
+            # drop the node itself (or the farthest if ties hid it)
+            keep = idx != rows[:, np.newaxis]
+            keep[keep.all(axis=1), -1] = False
+            cols = np.sort(idx[keep].reshape(n, k), axis=1)
+            self.indptr = np.arange(n+1) * cols.shape[1]
+            self.indices = cols.ravel()
+        elif cKDTree is not None:
+            if torus is None:
+                tree = cKDTree(self.pos)
+                near = tree.query_ball_point(self.pos, radius)
+            else:
+                tree = cKDTree(np.mod(self.pos, torus), boxsize=torus)
+                near = tree.query_ball_point(np.mod(self.pos, torus), radius)
+            near = [sorted(j for j in js if j != i) for i, js in enumerate(near)]
+            self.indptr = np.concatenate(([0], np.cumsum([len(js) for js in near])))
+            self.indices = np.fromiter((j for js in near for j in js), dtype=int, count=self.indptr[-1])
+        else:
+            counts = np.zeros(n, dtype=int)
+            parts = []
+            for start in range(0, n, chunk):
+                d = calc_dist_matrix(self.pos[start:start+chunk], self.pos, torus)
+                d[np.arange(len(d)), np.arange(start, start+len(d))] = np.inf
+                r, c = np.nonzero(d <= radius)
+                counts[start:start+len(d)] = np.bincount(r, minlength=len(d))
+                parts.append(c)
+            self.indptr = np.concatenate(([0], np.cumsum(counts)))
+            self.indices = np.concatenate(parts) if parts else np.empty(0, dtype=int)
+        self.data = calc_dist_pairs(self.pos[np.repeat(rows, np.diff(self.indptr))],
+                                    self.pos[self.indices], torus)
+
+    @property
+    def n_arcs (self):
+        return len(self.indices)
+
+    def neighbours (self, i):
+        """Indices and distances of the stored neighbours of node i"""
+        start, end = self.indptr[i], self.indptr[i+1]
+        return self.indices[start:end], self.data[start:end]
+
+    def to_csv (self, ids, network_f="network.csv"):
+        """Write the stored arcs in network.csv format"""
+        ids = np.asarray(ids)
+        orig = np.repeat(ids, np.diff(self.indptr)).tolist()
+        dest = ids[self.indices].tolist()
+        with open(network_f, 'w', newline='') as csvnetwork:
+            writer = csv.writer(csvnetwork)
+            header = ["Orig","Dest","Cost","Active"]
+            writer.writerow(header)
+            writer.writerows(zip(orig, dest, self.data.tolist(), ["Y"]*len(dest)))
+
+
+class DistanceCache ():
+    """
+    Distances of a node layout (IDs and positions): the full matrix (up to
+    max_nodes) and the sparse network are kept and shared by every problem
+    with the same layout, until an agent is added, removed or moved
+    """
+    def __init__(self, max_nodes=DIST_CACHE_MAX):
+        self.max_nodes = max_nodes
+        self.ids = None
+        self.pos = None
+        self.torus = None
+        self.dist = None
+        self.network = None
+        # Incremented every time the layout changes
+        self.version = 0
+
+    def matches (self, ids, pos, torus=None):
+        return (self.ids is not None and torus == self.torus and np.array_equal(ids, self.ids)
+                and np.array_equal(pos, self.pos))
+
+    def update (self, ids, pos, torus=None, build=False):
+        """Set the layout (dropping the distances if it changed); True if it changed"""
+        ids = np.asarray(ids)
+        pos = np.asarray(pos, dtype=float).reshape(-1, 2)
+        changed = not self.matches(ids, pos, torus)
+        if changed:
+            self.ids = ids.copy()
+            self.pos = pos.copy()
+            self.torus = torus
+            self.dist = None
+            self.network = None
+            self.version += 1
+        if build and self.dist is None and len(pos) <= self.max_nodes:
+            self.dist = calc_dist_matrix(self.pos, torus=self.torus)
+        return changed
+
+    def invalidate (self):
+        """Forget the layout (distances are rebuilt on next use)"""
+        self.ids = None
+        self.dist = None
+        self.network = None
+        self.version += 1
+
+    def attach (self, problem):
+        """Share the cached distances with problem (after checking its layout)"""
+        self.update(problem.ids, problem.pos, problem.torus)
+        problem._cache = self
+        if self.dist is not None:
+            problem._dist = self.dist
+        if self.network is not None:
+            problem._network = self.network
+        return problem
+
+    def keep (self, problem):
+        """Store the distances computed by an attached problem"""
+        if problem._dist is not None and len(problem.pos) <= self.max_nodes:
+            self.dist = problem._dist
+        if problem._network is not None:
+            self.network = problem._network
+
+
+class Problem ():
+    """
+    In-memory problem: same content as input.csv without the disk round-trip
+    The node columns (ids, pos, products, demand, is_sp) are the primary
+    data; Node_list may be None and is then built on first use
+    """
+    def __init__(self, Node_list, torus=None, pos=None, demand=None, is_sp=None,
+                 ids=None, products=None):
+        self._Node_list = Node_list
+        # (width, height) of a toroidal space, None for a flat space
+        self.torus = torus
+        # Node columns as arrays (built from the nodes if not given)
+        if ids is None:
+            ids = [node.ID for node in Node_list]
+        if pos is None:
+            pos = [(node.Xpos, node.Ypos) for node in Node_list]
+        if products is None:
+            products = [float(node.Products) for node in Node_list]
+        if demand is None:
+            demand = [float(node.Demand) for node in Node_list]
+        if is_sp is None:
+            is_sp = [node.Type == "SP" for node in Node_list]
+        self.ids = np.array(ids, dtype=int)
+        self.pos = np.array(pos, dtype=float).reshape(-1, 2)
+        self.products = np.array(products, dtype=float)
+        self.demand = np.array(demand, dtype=float)
+        self.is_sp = np.array(is_sp, dtype=bool)
+        self._rows = None
+        self._dist = None
+        self._registry = None
+        self._network = None
+        # DistanceCache shared with the problems of the same layout
+        self._cache = None
+
+    @classmethod
+    def from_arrays (cls, ids, types, pos, products, demand, torus=None):
+        """Problem from node columns (arrays with one value per node)"""
+        is_sp = np.asarray(types) == "SP"
+        return cls(None, torus, pos, demand, is_sp, ids, products)
+
+    @property
+    def Node_list (self):
+        """Node objects of the problem (built from the arrays on first use)"""
+        if self._Node_list is None:
+            types = np.where(self.is_sp, "SP", "DC").tolist()
+            self._Node_list = [Node(*row) for row in zip(self.ids.tolist(), types,
+                                                         self.pos[:, 0].tolist(), self.pos[:, 1].tolist(),
+                                                         self.products.tolist(), self.demand.tolist())]
+        return self._Node_list
+
+    def row_of (self, ID):
+        """Row of node ID in the problem arrays (None if not in the problem)"""
+        if self._rows is None:
+            self._rows = {ID: i for i, ID in enumerate(self.ids.tolist())}
+        return self._rows.get(ID)
+
+    def demand_shops (self):
+        """Indices of the shops with demand"""
+        return np.flatnonzero(self.is_sp & (self.demand != 0)).tolist()
+
+    def __getstate__ (self):
+        # Caches are rebuilt on demand (keeps process pool transfers small)
+        state = self.__dict__.copy()
+        state["_Node_list"] = None
+        state["_rows"] = None
+        state["_dist"] = None
+        state["_registry"] = None
+        state["_network"] = None
+        state["_cache"] = None
+        return state
+
+    @property
+    def registry (self):
+        """Node lookup indexes (built once, on first use)"""
+        if self._registry is None:
+            self._registry = NodeRegistry(self.Node_list)
+        return self._registry
+
+    def depot_index (self):
+        """Spatial index over the depots of the problem"""
+        dc_idx = np.flatnonzero(~self.is_sp)
+        return DepotIndex(self.ids[dc_idx].tolist(), self.pos[dc_idx], self.torus)
+
+    @property
+    def dist (self):
+        """Distance matrix between all nodes (computed once, on first use)"""
+        if self._dist is None:
+            self._dist = calc_dist_matrix(self.pos, torus=self.torus)
+            if self._cache is not None:
+                self._cache.keep(self)
+        return self._dist
+
+    def network (self, k=None, radius=None):
+        """Sparse k nearest neighbour (or radius) network (built once per k/radius)"""
+        if self._network is None or (self._network.k, self._network.radius) != (k, radius):
+            self._network = SparseNetwork(self.pos, k, radius, self.torus)
+            if self._cache is not None:
+                self._cache.keep(self)
+        return self._network
+
+    def mean_dist (self, samples=None, seed=None, chunk=4096):
+        """
+        Average distance between two different nodes: exact (chunked, no
+        full matrix) or estimated from samples random pairs if there are more
+        """
+        n = len(self.pos)
+        if n < 2:
+            return np.nan
+        if self._dist is not None:
+            return self._dist.sum() / (n * (n-1))
+        if samples is None or n * (n-1) <= samples:
+            total = 0.0
+            for start in range(0, n, chunk):
+                total += calc_dist_matrix(self.pos[start:start+chunk], self.pos, self.torus).sum()
+            return total / (n * (n-1))
+        rng = np.random.default_rng(seed)
+        i = rng.integers(0, n, samples)
+        # j uniform over the other nodes
+        j = (i + rng.integers(1, n, samples)) % n
+        return calc_dist_pairs(self.pos[i], self.pos[j], self.torus).mean()
+
+    def dist_from (self, i, js=None):
+        """Distances from node i to nodes js (all if None), from the matrix if built"""
+        if self._dist is not None:
+            return self._dist[i] if js is None else self._dist[i, js]
+        pos = self.pos if js is None else self.pos[js]
+        return calc_dist_matrix(self.pos[i], pos, self.torus)[0]
+
+    def subproblem (self, indices):
+        """New problem with the nodes at indices (sharing the distances)"""
+        Node_list = None
+        if self._Node_list is not None:
+            Node_list = [self._Node_list[i] for i in indices]
+        sub = Problem(Node_list, self.torus, self.pos[indices], self.demand[indices],
+                      self.is_sp[indices], self.ids[indices], self.products[indices])
+        if self._dist is not None:
+            sub._dist = self._dist[np.ix_(indices, indices)]
+        return sub
+
+    def to_csv (self, input_f="input.csv"):
+        """Optional sink: write the problem in input.csv format"""
+        with open(input_f, 'w', newline='') as csvinput:
+            writer = csv.writer(csvinput)
+            header = ["ID","Type","Xpos","Ypos","Products","Demand"]
+            writer.writerow(header)
+            for node in self.Node_list:
+                row = [node.ID, node.Type, node.Xpos, node.Ypos, node.Products, node.Demand]
+                writer.writerow(row)
+
+    def to_vrp_csv (self, vrp_f):
+        """Optional sink: write a depot sub-problem in vrp_N.csv format"""
+        with open(vrp_f, 'w', newline='') as csvoutput:
+            writer = csv.writer(csvoutput)
+            # write depot coordinates with demand = 0
+            depot = self.Node_list[0]
+            writer.writerow([depot.Xpos, depot.Ypos, 0])
+            # write shop coordinates with positive demand
+            for node in self.Node_list[1:]:
+                writer.writerow([node.Xpos, node.Ypos, abs(float(node.Demand))])
+
+    def to_binary (self, bin_f, routes=None, dist=True, update=False):
+        """Optional sink: write the problem (and routes) in the binary format"""
+        write_binary(bin_f, self, routes, dist, update)
+
+
+class LocalSearch ():
+    """
+    Improve a closed route with 2-opt and Or-opt moves
+    Move costs are O(1) deltas on the distance matrix, candidates come
+    from neighbour lists and don't-look bits keep settled nodes out
+    pos (and torus): node positions, the neighbour lists then come from a
+    spatial index instead of a pass over the whole distance matrix
+    """
+    EPS = 1e-9
+
+    def __init__(self, dist, n_neigh=8, seg_max=3, pos=None, torus=None):
+        self.dist = dist
+        self.seg_max = seg_max
+        n = len(dist)
+        k = min(n_neigh, n-1)
+        self.neigh = [[] for i in range(n)]
+        if k > 0 and pos is not None:
+            rows = np.arange(n)
+            _, near = DepotIndex(rows, pos, torus).query(pos, k+1)
+            # drop the node itself (or the farthest if ties hid it)
+            keep = near != rows[:, np.newaxis]
+            keep[keep.all(axis=1), -1] = False
+            self.neigh = near[keep].reshape(n, k).tolist()
+        elif k > 0:
+            d = np.array(dist, dtype=float)
+            np.fill_diagonal(d, np.inf)
+            near = np.argpartition(d, k-1, axis=1)[:, :k]
+            order = np.argsort(np.take_along_axis(d, near, axis=1), axis=1)
+            self.neigh = np.take_along_axis(near, order, axis=1).tolist()
+
+    def improve (self, order, time_budget=None, max_iter=None, active=None, start=None):
+        """
+        Improved visiting order (same first node) within the budget:
+        time_budget in seconds and/or max_iter node evaluations
+        active: nodes to start from (all if None), others start settled
+        start: perf_counter() time the budget counts from (default: now),
+        e.g. taken before building the LocalSearch
+        """
+        if len(order) < 4:
+            return list(order)
+        if start is None:
+            start = perf_counter()
+        self.tour = list(order)
+        self.pos = {node: k for k, node in enumerate(self.tour)}
+        active = set(self.tour if active is None else active)
+        self.queue = deque(node for node in self.tour if node in active)
+        self.active = set(self.queue)
+        iters = 0
+        while self.queue:
+            if max_iter is not None and iters >= max_iter:
+                break
+            if time_budget is not None and perf_counter() - start > time_budget:
+                break
+            a = self.queue.popleft()
+            self.active.discard(a)
+            iters += 1
+            if self.two_opt(a) or self.or_opt(a):
+                self.push(a)
+        # Rotate back to start from the same node (depot)
+        k = self.pos[order[0]]
+        return self.tour[k:] + self.tour[:k]
+
+    def push (self, *nodes):
+        """Clear the don't-look bits of the nodes"""
+        for node in nodes:
+            if node not in self.active:
+                self.active.add(node)
+                self.queue.append(node)
+
+    def succ (self, node):
+        return self.tour[(self.pos[node]+1) % len(self.tour)]
+
+    def pred (self, node):
+        return self.tour[self.pos[node]-1]
+
+    def reverse (self, i, j):
+        """Replace edges (tour[i], tour[i+1]) and (tour[j], tour[j+1])"""
+        if i > j:
+            i, j = j, i
+        self.tour[i+1:j+1] = self.tour[i+1:j+1][::-1]
+        for k in range(i+1, j+1):
+            self.pos[self.tour[k]] = k
+
+    def two_opt (self, a):
+        """First improving 2-opt move around node a"""
+        d = self.dist
+        for forward in (True, False):
+            b = self.succ(a) if forward else self.pred(a)
+            d_ab = d[a, b]
+            for c in self.neigh[a]:
+                d_ac = d[a, c]
+                if d_ac >= d_ab:
+                    break
+                e = self.succ(c) if forward else self.pred(c)
+                if c == b or e == a:
+                    continue
+                delta = d_ac + d[b, e] - d_ab - d[c, e]
+                if delta < -self.EPS:
+                    if forward:
+                        self.reverse(self.pos[a], self.pos[c])
+                    else:
+                        self.reverse(self.pos[b], self.pos[e])
+                    self.push(a, b, c, e)
+                    return True
+        return False
+
+    def or_opt (self, a):
+        """First improving move of a segment (1 to seg_max nodes) starting at a"""
+        d = self.dist
+        n = len(self.tour)
+        i = self.pos[a]
+        for length in range(1, self.seg_max+1):
+            if length > n-3:
+                break
+            seg = [self.tour[(i+k) % n] for k in range(length)]
+            s1, s2 = seg[0], seg[-1]
+            p = self.pred(s1)
+            nx = self.succ(s2)
+            gain = d[p, s1] + d[s2, nx] - d[p, nx]
+            if gain <= self.EPS:
+                continue
+            for c in self.neigh[s1]:
+                if c in seg:
+                    continue
+                for u, v in ((c, self.succ(c)), (self.pred(c), c)):
+                    if u in seg or v in seg:
+                        continue
+                    d_uv = d[u, v]
+                    add = d[u, s1] + d[s2, v] - d_uv
+                    add_rev = d[u, s2] + d[s1, v] - d_uv
+                    if min(add, add_rev) - gain < -self.EPS:
+                        if add_rev < add:
+                            seg = seg[::-1]
+                        self.move(seg, u)
+                        self.push(p, nx, u, v, s1, s2)
+                        return True
+        return False
+
+    def move (self, seg, u):
+        """Move the segment right after node u"""
+        moved = set(seg)
+        tour = [node for node in self.tour if node not in moved]
+        k = tour.index(u)
+        tour[k+1:k+1] = seg
+        self.tour = tour
+        self.pos = {node: k for k, node in enumerate(tour)}
+
+
+class Insertion ():
+    """
+    Cheapest insertion of shops into the routes of one depot
+    The edges of all the routes are stacked in arrays, so the best
+    position (within capacity) is one vectorized evaluation per shop
+    """
+    def __init__(self, problem, routes, capacity=None):
+        self.problem = problem
+        self.routes = routes
+        self.capacity = capacity
+        self.pending = []
+        self.edges = None
+
+    def add (self, r):
+        """Take route r (index in routes) into account"""
+        problem = self.problem
+        route = self.routes[r]
+        rows = [problem.row_of(stop) for stop in route]
+        pos = problem.pos[rows]
+        pos_next = np.roll(pos, -1, axis=0)
+        n = len(route)
+        load = np.abs(problem.demand[rows[1:]]).sum()
+        self.pending.append((pos, pos_next, calc_dist_pairs(pos, pos_next, self.problem.torus),
+                             np.full(n, r), np.arange(n), np.full(n, float(load))))
+
+    def stack (self):
+        """Edge arrays: orig pos, dest pos, length, route, position, route load"""
+        if self.pending:
+            if self.edges is not None:
+                self.pending.insert(0, self.edges)
+            self.edges = [np.concatenate(column) for column in zip(*self.pending)]
+            self.pending = []
+        return self.edges
+
+    def insert (self, ID):
+        """Insert shop ID at its cheapest position; route index or None"""
+        edges = self.stack()
+        if edges is None:
+            return None
+        pos_u, pos_v, length, route_of, k_of, load = edges
+        i = self.problem.row_of(ID)
+        q = abs(float(self.problem.demand[i]))
+        pos = self.problem.pos[i]
+        torus = self.problem.torus
+        d_u = calc_dist_matrix(pos, pos_u, torus)[0]
+        d_v = calc_dist_matrix(pos, pos_v, torus)[0]
+        cost = d_u + d_v - length
+        if self.capacity is not None:
+            cost[load + q > self.capacity] = np.inf
+        g = int(np.argmin(cost))
+        if not np.isfinite(cost[g]):
+            return None
+        # Edge (u, v) becomes (u, ID) and (ID, v)
+        r = int(route_of[g])
+        k = int(k_of[g])
+        self.routes[r].insert(k+1, ID)
+        in_route = route_of == r
+        k_of[in_route & (k_of > k)] += 1
+        load[in_route] += q
+        length[g] = d_u[g]
+        self.edges = [np.insert(pos_u, g+1, pos, axis=0),
+                      np.insert(pos_v, g, pos, axis=0),
+                      np.insert(length, g+1, d_v[g]),
+                      np.insert(route_of, g+1, r),
+                      np.insert(k_of, g+1, k+1),
+                      np.insert(load, g+1, load[g])]
+        return r
+
+
 class HSolver ():
     """Solver with multiple heuristics for the VRP variants"""
     
-    # def __init__(self):
+    def __init__(self, export_csv=False, workers=1, improve=False, time_budget=None, max_iter=None,
+                 capacity=None, balance=False, balance_k=BALANCE_K, cluster_size=None):
+        # Write vrp_N.csv and output.csv files as a side product
+        self.export_csv = export_csv
+        # Processes for the depot sub-problems (1: serial, None: all CPUs)
+        self.workers = workers
+        self._executor = None
+        # Local search after the greedy route, budget per depot route
+        self.improve = improve
+        self.time_budget = time_budget
+        self.max_iter = max_iter
+        # Vehicle capacity (None: one uncapacitated route per depot)
+        self.capacity = capacity
+        # Balance the shop demand against the depot stock (else nearest depot)
+        self.balance = balance
+        self.balance_k = balance_k
+        # Route the shops of a depot in angular sectors of at most cluster_size
+        self.cluster_size = cluster_size
+
+    def __getstate__ (self):
+        # The process pool stays in the parent process
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def executor (self):
+        """Process pool for the depot sub-problems (created on first use)"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def close (self):
+        """Shut down the process pool (if any)"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def map_depots (self, func, vrps):
+        """
+        Apply func to every depot sub-problem and return the results in
+        depot order; in a process pool if workers != 1, serial otherwise
+        or if the pool fails
+        """
+        if self.workers == 1 or len(vrps) < 2:
+            return [func(vrp) for vrp in vrps]
+        try:
+            return list(self.executor().map(func, vrps))
+        except Exception as error:
+            print("process pool failed ({0}), solving depots serially".format(error))
+            self.close()
+            return [func(vrp) for vrp in vrps]
     
     def solve_MD_short (self):
         """Solve Multi-Depot part of the problem by shortest path"""
@@ -56,22 +729,19 @@ class HSolver ():
             read = list(reader)
             dc_sp = []
             dc_sp_pos = []
-            for row_sp in read:
-                dist_min = np.inf
-                if row_sp["Type"] == "SP":
-                    dist_min = np.inf
-                    for row_dc in read:
-                        if row_dc["Type"] == "DC":
-                            pos1 = (int(row_sp["Xpos"]),int(row_sp["Ypos"]))
-                            pos2 = (int(row_dc["Xpos"]),int(row_dc["Ypos"]))
-                            dist = calc_dist(pos1, pos2)
-                            if dist < dist_min:
-                                dist_min = dist
-                                dc_min = row_dc["ID"]
-                                dc_min_pos = (row_dc["Xpos"],row_dc["Ypos"])
-                    dc_sp.append((dc_min,row_sp["ID"]))
-                    sp_pos = (row_sp["Xpos"],row_sp["Ypos"])
-                    dc_sp_pos.append((dc_min_pos,sp_pos))
+            rows_dc = [row for row in read if row["Type"] == "DC"]
+            rows_sp = [row for row in read if row["Type"] == "SP"]
+            pos_dc = [(int(row["Xpos"]),int(row["Ypos"])) for row in rows_dc]
+            pos_sp = [(int(row["Xpos"]),int(row["Ypos"])) for row in rows_sp]
+            depot_index = DepotIndex(range(len(rows_dc)), pos_dc)
+            nearest = depot_index.nearest(pos_sp)
+            for row_sp, j in zip(rows_sp, nearest):
+                row_dc = rows_dc[j]
+                dc_min = row_dc["ID"]
+                dc_min_pos = (row_dc["Xpos"],row_dc["Ypos"])
+                dc_sp.append((dc_min,row_sp["ID"]))
+                sp_pos = (row_sp["Xpos"],row_sp["Ypos"])
+                dc_sp_pos.append((dc_min_pos,sp_pos))
                     
             # Output the vrp*.csv files
             outfiles = []
@@ -98,198 +768,532 @@ class HSolver ():
         return dc_sp, dc_sp_pos, outfiles
 
 
-    def solve_MD_short_demand (self):
+    def solve_MD_short_demand (self, problem=None, depot_index=None):
         """
         Solve Multi-Depot part of the problem by shortest path
         Taking into account the demand for each shop
+        Returns one sub-problem per depot (depot node first)
+        depot_index: DepotIndex over the problem depots (built if None)
         """
-        # Delete all "vrp*.csv" files in folder
-        del_files_by_pattern(r"(vrp_\d{1,2}).csv$")
+        if problem is None:
+            problem = Problem(parse_input())
+        if depot_index is None:
+            depot_index = problem.depot_index()
                         
         # Solve the MD problem
-        Node_list = parse_input()
+        ids = problem.ids.tolist()
+        sp_idx = problem.demand_shops()
         dc_sp = []
         dc_sp_pos = []
-        for node_sp in Node_list:
-            if float(node_sp.Demand) != 0 and node_sp.Type == "SP":
-                dist_min = np.inf
-                for node_dc in Node_list:
-                    if node_dc.Type == "DC":
-                        pos_sp = (int(node_sp.Xpos), int(node_sp.Ypos))
-                        pos_dc = (int(node_dc.Xpos), int(node_dc.Ypos))
-                        dist = calc_dist(pos_sp, pos_dc)
-                        if dist < dist_min:
-                            dist_min = dist
-                            dc_min = node_dc.ID
-                            dc_min_pos = pos_dc
-                dc_sp.append((dc_min,node_sp.ID))
-                dc_sp_pos.append((dc_min_pos,pos_sp))
+        assigned = {}
+        if sp_idx and depot_index.ids:
+            if self.balance:
+                # k nearest depots for every shop in one batch query
+                dist, near = depot_index.query(problem.pos[sp_idx], self.balance_k)
+                stock = problem.products[[problem.row_of(ID) for ID in depot_index.ids]]
+                nearest = regret_assignment(np.abs(problem.demand[sp_idx]), stock, dist, near)
+            else:
+                # Nearest depot for every shop in one batch query
+                nearest = depot_index.nearest(problem.pos[sp_idx])
+            pos = problem.pos.tolist()
+            for i, j in zip(sp_idx, nearest):
+                dc = depot_index.ids[j]
+                dc_sp.append((dc,ids[i]))
+                dc_sp_pos.append((tuple(pos[problem.row_of(dc)]),tuple(pos[i])))
+                if dc not in assigned:
+                    assigned[dc] = []
+                assigned[dc].append(i)
                             
-        # Output the vrp*.csv files
-        outfiles = []
-        try:
-            for dc in range(int(max(dc_sp)[0])+1):
-                f_name = "vrp_"+str(dc)+".csv"
-                outfiles.append(f_name)
-                with open(f_name, 'w', newline='') as csvoutput:
-                    writer = csv.writer(csvoutput)
-                    # write depot coordinates with demand = 0
-                    for node in Node_list:
-                        if node.ID == str(dc):
-                            writer.writerow([node.Xpos, node.Ypos,0])
-                    # write shop coordinates with positive demand
-                    for sol in dc_sp:
-                        if int(sol[0]) == dc:
-                            for node in Node_list:
-                                # print (node.Demand)
-                                # print (type(node.Demand))
-                                if node.ID == sol[1] and float(node.Demand) != 0:
-                                    sp_x = node.Xpos
-                                    sp_y = node.Ypos
-                                    sp_demand = abs(float(node.Demand))
-                                    row = [sp_x, sp_y, sp_demand]
-                                    writer.writerow(row)
-        except: # case when 
-            print("exception due to no demand -> 'dc_sp' is: ",dc_sp)
+        # Create the sub-problems (one per depot up to the last one used)
+        subproblems = []
+        if dc_sp:
+            for dc in range(max(dc_sp)[0]+1):
+                i = problem.row_of(dc)
+                if i is not None and not problem.is_sp[i]:
+                    sub = problem.subproblem([i] + assigned.get(dc, []))
+                    subproblems.append(sub)
+        else:
+            print("no demand -> 'dc_sp' is: ",dc_sp)
+
+        # Output the vrp*.csv files (optional)
+        if self.export_csv:
+            # Delete all "vrp*.csv" files in folder
+            del_files_by_pattern(r"(vrp_\d{1,2}).csv$")
+            for sub in subproblems:
+                sub.to_vrp_csv("vrp_"+str(sub.ids[0])+".csv")
                 
-        return dc_sp, dc_sp_pos, outfiles
+        return dc_sp, dc_sp_pos, subproblems
 
+    def read_vrp (self, vrp_f, input_f="input.csv"):
+        """Load a vrp_N.csv file as a sub-problem"""
+        registry = NodeRegistry(parse_input(input_f))
+        with open(vrp_f, newline='') as vrpfile:
+            vrp_reader = csv.reader(vrpfile)
+            dc_line = next(vrp_reader)
+            dc_x, dc_y = (to_num(dc_line[0]),to_num(dc_line[1]))
+            dc_id = registry.find_by_pos((dc_x, dc_y)).ID
+            dc = Node (dc_id, "DC", dc_x, dc_y, 0, 0)
+            Node_list = [dc]
+            for node in vrp_reader:
+                n_x, n_y = (to_num(node[0]),to_num(node[1]))
+                n_id = registry.find_by_pos((n_x, n_y)).ID
+                n_demand = float(node[2])
+                n = Node(n_id, "SP", n_x, n_y, 0, n_demand)
+                Node_list.append(n)
+        return Problem(Node_list)
     
-    def solve_VRP_greedy (self, vrp_f, input_f="input.csv"):
+    def solve_VRP_greedy (self, vrp, input_f="input.csv"):
         """
         Solve single VRP by using simple greedy behaviour
         Demand not considered
+        vrp: sub-problem (depot node first) or vrp_N.csv file name
         """
-        # Create candidate list
-        with open(vrp_f, newline='') as vrpfile:
-            vrp_reader = csv.reader(vrpfile)
-            dc_line = next(vrp_reader)
-            # vrp_read = list(vrp_reader)
-            with open(input_f, newline='') as inputfile:
-                input_reader = csv.DictReader(inputfile)
-                input_read = list(input_reader)
-                dc_x, dc_y = (int(dc_line[0]),int(dc_line[1]))
-                dc_id = self.map_coord_to_id ((dc_x, dc_y))
-                dc = Node (dc_id, "DC", dc_x, dc_y, 0, 0)
-                # dc.print_node_info()
-                candidates = [dc]
-                for node in vrp_reader:
-                    n_x, n_y = (int(node[0]),int(node[1]))
-                    n_id = self.map_coord_to_id ((n_x, n_y))
-                    n_demand = float(node[2])
-                    n = Node(n_id, "SP", n_x, n_y, 0, n_demand)
-                    # n.print_node_info()
-                    candidates.append(n)
-        # print("There are {0} nodes in vrp.".format(len(candidates)))
-        # Iterate inside candidate list to generate route order
-        route = [candidates[0].ID]
-        while len(candidates) > 1:
-            dist_min = np.inf
-            pos1 = (candidates[0].Xpos,candidates[0].Ypos)
-            candidates.pop(0)
-            next_n = []
-            for node in candidates:
-                pos2 = (node.Xpos,node.Ypos)
-                dist = calc_dist(pos1, pos2)
-                if dist < dist_min:
-                    dist_min = dist
-                    next_n = node
-            i = candidates.index(next_n)
-            candidates.pop(i)
-            candidates.insert(0, next_n)
-            route.append(next_n.ID)
+        if isinstance(vrp, str):
+            vrp = self.read_vrp(vrp, input_f)
+        order = nearest_neighbour_order(vrp)
+        route = vrp.ids[order].tolist()
         # print("greedy route for {0}: {1}".format(vrp_f, route))
 
         return route
     
-    def aggregate_VRP (self, *args):
+    def solve_VRP (self, vrp):
+        """
+        Solve single VRP: greedy route, then 2-opt/Or-opt local search
+        (if improve) within time_budget seconds / max_iter evaluations
+        """
+        order = nearest_neighbour_order(vrp)
+        if self.improve:
+            start = perf_counter()
+            ls = LocalSearch(vrp.dist, pos=vrp.pos, torus=vrp.torus)
+            order = ls.improve(order, self.time_budget, self.max_iter, start=start)
+        return vrp.ids[order].tolist()
+
+    def solve_CVRP_savings (self, vrp):
+        """
+        Solve single capacitated VRP by Clarke-Wright savings
+        Returns one route (trip) per vehicle, each starting at the depot
+        """
+        trips = savings_trips(vrp, self.capacity)
         routes = []
-        for file in args:
-            route = self.solve_VRP_greedy(file)
-            routes.append(route)
+        for trip in trips:
+            order = [0] + trip
+            if self.improve:
+                start = perf_counter()
+                ls = LocalSearch(vrp.dist[np.ix_(order, order)], pos=vrp.pos[order], torus=vrp.torus)
+                local = ls.improve(list(range(len(order))), self.time_budget, self.max_iter,
+                                   start=start)
+                order = [order[k] for k in local]
+            routes.append(vrp.ids[order].tolist())
+        return routes
+
+    def solve_depot (self, vrp):
+        """Routes of a depot sub-problem (several trips if capacity is set)"""
+        if self.capacity is None:
+            return [self.solve_VRP(vrp)]
+        return self.solve_CVRP_savings(vrp)
+
+    def solve_depots (self, vrps):
+        """
+        Routes of every depot sub-problem (one list per sub-problem), all
+        solved in one map_depots call; with cluster_size the sectors of
+        every depot are routed separately and stitched back
+        """
+        if self.cluster_size is None:
+            return self.map_depots(self.solve_depot, vrps)
+        # Route all sectors (of all depots) together, then stitch them
+        sectors = [self.decompose(vrp) for vrp in vrps]
+        solved = iter(self.map_depots(self.solve_depot, [sub for subs in sectors for sub in subs]))
+        results = []
+        for subs in sectors:
+            pieces = [next(solved) for sub in subs]
+            if self.capacity is None:
+                # One route per depot: sectors in angular order
+                route = pieces[0][0]
+                for piece in pieces[1:]:
+                    route = route + piece[0][1:]
+                results.append([route])
+            else:
+                results.append([trip for piece in pieces for trip in piece])
+        return results
+
+    def decompose (self, vrp):
+        """Depot sub-problem split in angular sectors of at most cluster_size shops"""
+        if self.cluster_size is None or len(vrp.ids) - 1 <= self.cluster_size:
+            return [vrp]
+        return [vrp.subproblem([0] + sector) for sector in angular_sectors(vrp, self.cluster_size)]
+
+    def reroute (self, problem, routes, depot_index=None, timings=None):
+        """
+        Update the routes of the previous step instead of solving again:
+        drop the shops without demand, add the new ones by cheapest
+        insertion and (if improve) run the local search around the changes
+        only, within time_budget / max_iter as solve_VRP
+        The routes follow the aggregate_VRP rules: in depot order, without
+        capacity one route per depot up to the last one with shops (depot
+        only routes included), with capacity no empty trips
+        timings: dict to store the depot assignment time ("assign", s) in
+        """
+        if depot_index is None:
+            depot_index = problem.depot_index()
+        demand = problem.ids[problem.demand_shops()].tolist()
+        demand_set = set(demand)
+
+        # Remove the shops without demand, or over capacity since their
+        # demand changed (their neighbours are touched)
+        new_routes = []
+        touched = {}
+        routed = set()
+        for route in routes:
+            if problem.row_of(route[0]) is None:
+                continue
+            kept = [route[0]]
+            load = 0
+            around = set()
+            removed = False
+            for ID in route[1:]:
+                if ID in demand_set and ID not in routed:
+                    if self.capacity is not None:
+                        q = abs(float(problem.demand[problem.row_of(ID)]))
+                        if len(kept) > 1 and load + q > self.capacity:
+                            removed = True
+                            continue
+                        load += q
+                    if removed:
+                        around.update((kept[-1], ID))
+                        removed = False
+                    kept.append(ID)
+                    routed.add(ID)
+                else:
+                    removed = True
+            if removed:
+                around.update((kept[-1], kept[0]))
+            if around:
+                touched[len(new_routes)] = around
+            new_routes.append(kept)
+        routes = new_routes
+
+        # Insert the new shops in the routes of their nearest depot (or
+        # the balanced one)
+        new = [ID for ID in demand if ID not in routed]
+        if new:
+            t_assign = perf_counter()
+            idx = [problem.row_of(ID) for ID in new]
+            if self.balance:
+                # Balance the new shops against the stock left after the
+                # demand already routed from every depot
+                dist, near = depot_index.query(problem.pos[idx], self.balance_k)
+                stock = {ID: float(problem.products[problem.row_of(ID)]) for ID in depot_index.ids}
+                for route in routes:
+                    rows = [problem.row_of(ID) for ID in route[1:]]
+                    stock[route[0]] -= np.abs(problem.demand[rows]).sum()
+                stock = [stock[ID] for ID in depot_index.ids]
+                nearest = regret_assignment(np.abs(problem.demand[idx]), stock, dist, near)
+            else:
+                nearest = depot_index.nearest(problem.pos[idx])
+            if timings is not None:
+                timings["assign"] = perf_counter() - t_assign
+            inserters = {}
+            for r, route in enumerate(routes):
+                if route[0] not in inserters:
+                    inserters[route[0]] = Insertion(problem, routes, self.capacity)
+                inserters[route[0]].add(r)
+            left = {}
+            for ID, i, j in zip(new, idx, nearest):
+                dc = depot_index.ids[j]
+                if dc not in inserters:
+                    inserters[dc] = Insertion(problem, routes, self.capacity)
+                r = inserters[dc].insert(ID)
+                if r is None and self.capacity is None:
+                    routes.append([dc, ID])
+                    r = len(routes)-1
+                    inserters[dc].add(r)
+                if r is None:
+                    if dc not in left:
+                        left[dc] = []
+                    left[dc].append(i)
+                    continue
+                if r not in touched:
+                    touched[r] = set()
+                touched[r].add(ID)
+            # Shops that fit in no route get new trips (savings)
+            for dc, idx_left in left.items():
+                vrp = problem.subproblem([problem.row_of(dc)] + idx_left)
+                routes.extend(self.solve_CVRP_savings(vrp))
+
+        # Local repair of the touched routes
+        if self.improve:
+            for r, around in touched.items():
+                routes[r] = self.repair_route(problem, routes[r], around)
+        if self.capacity is not None:
+            routes = [route for route in routes if len(route) > 1]
+        else:
+            used = [route[0] for route in routes if len(route) > 1]
+            last = max(used) if used else None
+            have = set(route[0] for route in routes)
+            routes += [[dc] for dc in depot_index.ids if dc not in have]
+            routes = [route for route in routes if last is not None and route[0] <= last]
+        routes.sort(key=lambda route: route[0])
+
+        # Write output file (optional)
+        if self.export_csv:
+            write_output(routes, problem.registry)
+        return routes
+
+    def repair_route (self, problem, route, around):
+        """Local search on a route starting from the stops in around only"""
+        if len(route) < 4:
+            return route
+        start = perf_counter()
+        pos = problem.pos[[problem.row_of(stop) for stop in route]]
+        ls = LocalSearch(calc_dist_matrix(pos, torus=problem.torus), pos=pos, torus=problem.torus)
+        active = [k for k, stop in enumerate(route) if stop in around]
+        order = ls.improve(list(range(len(route))), self.time_budget, self.max_iter, active, start)
+        return [route[k] for k in order]
+
+    def aggregate_VRP (self, *args, problem=None):
+        """
+        Route every depot sub-problem (or vrp_N.csv file)
+        The full problem is only needed to export output.csv
+        """
+        vrps = [self.read_vrp(vrp) if isinstance(vrp, str) else vrp for vrp in args]
+        routes = []
+        for depot_routes in self.solve_depots(vrps):
+            routes.extend(depot_routes)
         
-        # Write output file
-        Node_list = parse_input()            
-        with open("output.csv", 'w', newline='') as csvoutput:
-            writer = csv.writer(csvoutput)
-            # Write header
-            header = ["Route", "Arc", "Orig", "Dest", "Qty"]
-            writer.writerow(header)
-            count_r = 1
-            for route in routes:
-                route_id = count_r
-                count_a = 1
-                count = 0
-                node_o = find_node_by_id(Node_list, route[0])
-                for node in route:
-                    arc_id = count_a
-                    if count ==0:
-                        node_p = node_o
-                        count +=1
-                        continue
-                    elif count == len(route)-1:
-                        # Do as normal
-                        node_o = node_p
-                        node_d = find_node_by_id(Node_list, node)
-                        row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
-                        writer.writerow(row)
-                        # Add final row with round trip
-                        count_a +=1
-                        arc_id = count_a
-                        node_o = find_node_by_id(Node_list, node)
-                        node_d = find_node_by_id(Node_list, route[0])
-                        row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
-                        writer.writerow(row)
-                    else:
-                        node_o = node_p
-                        node_d = find_node_by_id(Node_list, node)
-                        node_p = node_d
-                        count +=1
-                        count_a += 1
-                        row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
-                        writer.writerow(row)
-                count_r += 1
+        # Write output file (optional)
+        if self.export_csv:
+            if problem is None:
+                problem = Problem(parse_input())
+            write_output(routes, problem.registry)
                         
         return routes
         
-    def map_coord_to_id (self, pos):
-        with open("input.csv", newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            read = list(reader)
-            x, y = pos
-            agent_id = "not"
-            for line in read:
-                if line["Xpos"] == str(x) and line ["Ypos"] == str(y):
-                    agent_id = line["ID"]
-            message = "Agent {0} found at ({1}, {2})".format(agent_id,x,y)
-        # print(message)
-        if agent_id != "not":
-            return agent_id
+    def map_coord_to_id (self, pos, input_f="input.csv"):
+        registry = NodeRegistry(parse_input(input_f))
+        node = registry.find_by_pos(pos)
+        # print("Agent {0} found at ({1}, {2})".format(node.ID, *pos))
+        if node is not None:
+            return node.ID
         
     #TODO: create "node_from_coord" function: from coordinates create node object with info from input.csv
 
 
 # Define the required Functions
 
-def calc_dist (pos1, pos2):
+def calc_dist (pos1, pos2, torus=None):
     """Calculate distance between 2 positions"""
     x1, y1 = pos1
     x2, y2 = pos2
     dx = np.abs(x1 - x2)
     dy = np.abs(y1 - y2)
+    if torus is not None:
+        dx = min(dx, torus[0] - dx)
+        dy = min(dy, torus[1] - dy)
     return np.sqrt(dx * dx + dy * dy) 
 
+def calc_dist_matrix (pos_a, pos_b=None, torus=None):
+    """
+    Calculate distances between all positions in pos_a and pos_b
+    (arrays of shape (N, 2); pos_b defaults to pos_a) in one batch
+    torus: (width, height) to wrap around as in ContinuousSpace
+    """
+    pos_a = np.asarray(pos_a, dtype=float).reshape(-1, 2)
+    if pos_b is None:
+        pos_b = pos_a
+    else:
+        pos_b = np.asarray(pos_b, dtype=float).reshape(-1, 2)
+    dx = np.abs(pos_a[:, 0, np.newaxis] - pos_b[np.newaxis, :, 0])
+    dy = np.abs(pos_a[:, 1, np.newaxis] - pos_b[np.newaxis, :, 1])
+    if torus is not None:
+        dx = np.minimum(dx, torus[0] - dx)
+        dy = np.minimum(dy, torus[1] - dy)
+    return np.sqrt(dx * dx + dy * dy)
+
+def calc_dist_pairs (pos_a, pos_b, torus=None):
+    """Calculate distances between pos_a[k] and pos_b[k] for every k"""
+    pos_a = np.asarray(pos_a, dtype=float).reshape(-1, 2)
+    pos_b = np.asarray(pos_b, dtype=float).reshape(-1, 2)
+    dx = np.abs(pos_a[:, 0] - pos_b[:, 0])
+    dy = np.abs(pos_a[:, 1] - pos_b[:, 1])
+    if torus is not None:
+        dx = np.minimum(dx, torus[0] - dx)
+        dy = np.minimum(dy, torus[1] - dy)
+    return np.sqrt(dx * dx + dy * dy)
+
+def nearest_neighbour_order (problem, start=0):
+    """
+    Visiting order (node indices) of the nearest neighbour heuristic
+    Remaining nodes are kept in an index array with a visited mask, so
+    every move is one vectorized distance row (first node on ties)
+    """
+    n = len(problem.ids)
+    if n == 0:
+        return []
+    remaining = np.arange(n)
+    visited = remaining == start
+    n_visited = 1
+    order = [start]
+    curr = start
+    while len(order) < n:
+        # Drop the visited nodes once they are half of the array
+        if 2*n_visited > len(remaining):
+            remaining = remaining[~visited]
+            visited = np.zeros(len(remaining), dtype=bool)
+            n_visited = 0
+        dist = problem.dist_from(curr, remaining)
+        dist[visited] = np.inf
+        i = int(np.argmin(dist))
+        visited[i] = True
+        n_visited += 1
+        curr = int(remaining[i])
+        order.append(curr)
+    return order
+
+def angular_sectors (problem, size):
+    """
+    Shops (indices 1..n, depot at 0) split in sectors of at most size
+    consecutive shops by angle around the depot
+    """
+    n = len(problem.ids) - 1
+    if n <= 0:
+        return []
+    delta = problem.pos[1:] - problem.pos[0]
+    if problem.torus is not None:
+        # shortest displacement across the edges
+        torus = np.asarray(problem.torus, dtype=float)
+        delta = (delta + torus/2) % torus - torus/2
+    angle = np.arctan2(delta[:, 1], delta[:, 0])
+    order = np.argsort(angle, kind="stable") + 1
+    n_sectors = -(-n // size)
+    return [sector.tolist() for sector in np.array_split(order, n_sectors)]
+
+def regret_assignment (demand, stock, dist, near):
+    """
+    Depot (index) for every shop, balancing the demand against the depot
+    stock: shops are taken by decreasing regret (extra distance to their
+    second nearest depot) and given the nearest of their k nearest depots
+    (dist, near: shape (shops, k)) with enough stock left, else the one
+    with the most stock left. If the demand exceeds the total stock, the
+    stock limits are scaled up in proportion
+    """
+    demand = np.asarray(demand, dtype=float)
+    left = np.maximum(np.asarray(stock, dtype=float), 0)
+    if left.sum() == 0:
+        return near[:, 0].copy()
+    left *= max(1.0, demand.sum() / left.sum())
+    if near.shape[1] > 1:
+        regret = dist[:, 1] - dist[:, 0]
+    else:
+        regret = np.zeros(len(demand))
+    assigned = near[:, 0].copy()
+    near_l = near.tolist()
+    demand_l = demand.tolist()
+    for s in np.argsort(-regret, kind="stable").tolist():
+        options = near_l[s]
+        for j in options:
+            if left[j] >= demand_l[s]:
+                break
+        else:
+            j = max(options, key=lambda j: left[j])
+        assigned[s] = j
+        left[j] -= demand_l[s]
+    return assigned
+
+def savings_trips (problem, capacity, n_neigh=30):
+    """
+    Clarke-Wright savings for a depot sub-problem (depot is node 0)
+    Savings come from the distance matrix in one vectorized step (only
+    the n_neigh nearest shops of every shop when there are more) and are
+    merged from a heap; shops with demand above capacity travel alone
+    Returns the trips as lists of shop indices
+    """
+    n = len(problem.ids)
+    if n < 2:
+        return []
+    dist = problem.dist
+    demand = np.abs(problem.demand).tolist()
+    # Candidate shop pairs (i, j)
+    if n-2 > n_neigh:
+        d = dist[1:, 1:].copy()
+        np.fill_diagonal(d, np.inf)
+        near = np.argpartition(d, n_neigh-1, axis=1)[:, :n_neigh]
+        i = np.repeat(np.arange(1, n), n_neigh)
+        j = near.ravel() + 1
+    else:
+        i, j = np.triu_indices(n, k=1)
+        keep = i > 0
+        i, j = i[keep], j[keep]
+    saving = dist[0, i] + dist[0, j] - dist[i, j]
+    keep = saving > 0
+    heap = list(zip((-saving[keep]).tolist(), i[keep].tolist(), j[keep].tolist()))
+    heapq.heapify(heap)
+
+    # Start with one trip per shop
+    trip_of = {k: k for k in range(1, n)}
+    trips = {k: deque([k]) for k in range(1, n)}
+    load = {k: demand[k] for k in range(1, n)}
+    while heap:
+        neg_s, a, b = heapq.heappop(heap)
+        ta, tb = trip_of[a], trip_of[b]
+        if ta == tb or load[ta] + load[tb] > capacity:
+            continue
+        trip_a, trip_b = trips[ta], trips[tb]
+        # Only trip ends can be linked: make it ... a][b ...
+        if trip_a[-1] != a:
+            if trip_a[0] != a:
+                continue
+            trip_a.reverse()
+        if trip_b[0] != b:
+            if trip_b[-1] != b:
+                continue
+            trip_b.reverse()
+        # Merge the smaller trip into the larger one
+        if len(trip_a) >= len(trip_b):
+            trip_a.extend(trip_b)
+            keep, drop = ta, tb
+        else:
+            trip_b.extendleft(reversed(trip_a))
+            keep, drop = tb, ta
+        for k in trips[drop]:
+            trip_of[k] = keep
+        load[keep] += load[drop]
+        del trips[drop], load[drop]
+    return [list(trips[k]) for k in sorted(trips)]
+
+def route_length (dist, order):
+    """Length of the closed route through the nodes in order"""
+    order = np.asarray(order)
+    if len(order) < 2:
+        return 0.0
+    return float(dist[order, np.roll(order, -1)].sum())
+
+def routes_length (problem, routes):
+    """Total length of the closed routes (lists of node IDs)"""
+    length = 0.0
+    for route in routes:
+        if len(route) > 1:
+            pos = problem.pos[[problem.row_of(ID) for ID in route]]
+            length += float(calc_dist_pairs(pos, np.roll(pos, -1, axis=0), problem.torus).sum())
+    return length
+
+def to_num (value):
+    """Convert a csv string to int (if possible) or float"""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
 def parse_input (input_f="input.csv"):
     Node_list = []
     with open(input_f, newline='') as csvfile:
         reader = csv.DictReader(csvfile)
         for line in reader:
-            ID = line["ID"]
+            ID = int(line["ID"])
             Type = line["Type"]
-            Xpos = line["Xpos"]
-            Ypos = line["Ypos"]
-            Products = line["Products"]
-            Demand = line["Demand"]
+            Xpos = to_num(line["Xpos"])
+            Ypos = to_num(line["Ypos"])
+            Products = to_num(line["Products"])
+            Demand = to_num(line["Demand"])
             node = Node(ID, Type, Xpos, Ypos, Products, Demand)
             Node_list.append(node)
     return Node_list
@@ -297,13 +1301,13 @@ def parse_input (input_f="input.csv"):
 def parse_route (file="output.csv"):
     """Returns a dict of lists of arc objects with route num. as keys"""
     Route_dict = {}
-    Node_list = parse_input()
+    registry = NodeRegistry(parse_input())
     with open(file, newline='') as output_f:
         reader = csv.DictReader(output_f)
         for r_arc in reader:
             ID = r_arc["Arc"] + "-" + r_arc["Route"]
-            orig_node = find_node_by_id(Node_list, r_arc["Orig"])
-            dest_node = find_node_by_id(Node_list, r_arc["Dest"])
+            orig_node = registry.find(int(r_arc["Orig"]))
+            dest_node = registry.find(int(r_arc["Dest"]))
             qty = r_arc["Qty"]
             arc = Arc(ID, orig_node, dest_node, qty)
             if r_arc["Route"] not in Route_dict:
@@ -314,6 +1318,147 @@ def parse_route (file="output.csv"):
     #     arc.print_arc_info()
     return Route_dict
 
+def write_output (routes, registry, output_f="output.csv"):
+    """Write the routes as arcs in output.csv format"""
+    with open(output_f, 'w', newline='') as csvoutput:
+        writer = csv.writer(csvoutput)
+        # Write header
+        header = ["Route", "Arc", "Orig", "Dest", "Qty"]
+        writer.writerow(header)
+        count_r = 1
+        for route in routes:
+            route_id = count_r
+            count_a = 1
+            count = 0
+            node_o = registry.find(route[0])
+            for node in route:
+                arc_id = count_a
+                if count ==0:
+                    node_p = node_o
+                    count +=1
+                    continue
+                elif count == len(route)-1:
+                    # Do as normal
+                    node_o = node_p
+                    node_d = registry.find(node)
+                    row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
+                    writer.writerow(row)
+                    # Add final row with round trip
+                    count_a +=1
+                    arc_id = count_a
+                    node_o = registry.find(node)
+                    node_d = registry.find(route[0])
+                    row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
+                    writer.writerow(row)
+                else:
+                    node_o = node_p
+                    node_d = registry.find(node)
+                    node_p = node_d
+                    count +=1
+                    count_a += 1
+                    row = [route_id, arc_id, node_o.ID, node_d.ID, node_d.Demand]
+                    writer.writerow(row)
+            count_r += 1
+
+def write_binary (bin_f, problem, routes=None, dist=True, update=False):
+    """
+    Write the node table, the distance matrix (if dist) and the routes
+    (lists of node IDs, if given) of problem to bin_f: a BIN_HEADER
+    followed by the arrays (little-endian, BIN_ALIGN aligned) so that
+    read_binary can memory-map them
+    update: bin_f already holds the distance matrix of this layout, only
+    the header, node table and routes are rewritten (matrix kept in place)
+    """
+    n = len(problem.ids)
+    nodes = np.zeros(n, dtype=BIN_NODE)
+    nodes["ID"] = problem.ids
+    nodes["Type"] = problem.is_sp
+    nodes["Xpos"] = problem.pos[:, 0]
+    nodes["Ypos"] = problem.pos[:, 1]
+    nodes["Products"] = problem.products
+    nodes["Demand"] = problem.demand
+    arrays = [nodes]
+    header = np.zeros(1, dtype=BIN_HEADER)
+    header["magic"] = BIN_MAGIC
+    header["version"] = BIN_VERSION
+    header["n_nodes"] = n
+    header["torus"] = problem.torus if problem.torus is not None else (np.nan, np.nan)
+    if update:
+        header["flags"] |= BIN_DIST
+        # Placeholder of the same size (not written)
+        arrays.append(np.broadcast_to(np.zeros(1, dtype="<f8"), (n, n)))
+    elif dist:
+        header["flags"] |= BIN_DIST
+        arrays.append(np.ascontiguousarray(problem.dist, dtype="<f8"))
+    else:
+        arrays.append(np.zeros(0, dtype="<f8"))
+    if routes is not None:
+        header["flags"] |= BIN_ROUTES
+        offsets = np.zeros(len(routes)+1, dtype="<i8")
+        offsets[1:] = np.cumsum([len(route) for route in routes])
+        stops = np.array([ID for route in routes for ID in route], dtype="<i8")
+        header["n_routes"] = len(routes)
+        header["n_stops"] = len(stops)
+        arrays += [offsets, stops]
+    else:
+        arrays += [np.zeros(0, dtype="<i8"), np.zeros(0, dtype="<i8")]
+    # Array offsets (aligned)
+    offset = BIN_HEADER.itemsize
+    for key, array in zip(["node_off", "dist_off", "route_off", "stop_off"], arrays):
+        offset += -offset % BIN_ALIGN
+        header[key] = offset
+        offset += array.nbytes
+    keys = ["node_off", "dist_off", "route_off", "stop_off"]
+    if update:
+        with open(bin_f, 'r+b') as binary:
+            binary.write(header.tobytes())
+            binary.seek(int(header["node_off"][0]))
+            arrays[0].tofile(binary)
+            binary.seek(int(header["dist_off"][0]) + arrays[1].nbytes)
+            for key, array in zip(keys[2:], arrays[2:]):
+                binary.write(bytes(int(header[key][0]) - binary.tell()))
+                array.tofile(binary)
+            binary.truncate()
+        return
+    with open(bin_f, 'wb') as binary:
+        binary.write(header.tobytes())
+        for key, array in zip(keys, arrays):
+            binary.write(bytes(int(header[key][0]) - binary.tell()))
+            array.tofile(binary)
+
+def read_binary (bin_f, mmap=True):
+    """
+    Read a file written by write_binary: returns (problem, routes), routes
+    is None if not stored. With mmap the distance matrix is memory-mapped
+    (read-only) instead of loaded
+    """
+    header = np.fromfile(bin_f, dtype=BIN_HEADER, count=1)
+    if len(header) == 0 or header["magic"][0] != BIN_MAGIC:
+        raise ValueError("{0} is not an AB_VRP binary file".format(bin_f))
+    header = header[0]
+    if header["version"] != BIN_VERSION:
+        info = [bin_f, header["version"], BIN_VERSION]
+        raise ValueError("{0}: binary format version {1} (expected {2})".format(*info))
+    n = int(header["n_nodes"])
+    def load(dtype, key, shape):
+        count = int(np.prod(shape))
+        if mmap and count:
+            return np.memmap(bin_f, dtype=dtype, mode='r', offset=int(header[key]), shape=shape)
+        return np.fromfile(bin_f, dtype=dtype, count=count, offset=int(header[key])).reshape(shape)
+    nodes = load(BIN_NODE, "node_off", (n,))
+    torus = None if np.isnan(header["torus"]).any() else tuple(header["torus"].tolist())
+    types = np.where(nodes["Type"] == 0, "DC", "SP")
+    pos = np.column_stack((nodes["Xpos"], nodes["Ypos"]))
+    problem = Problem.from_arrays(nodes["ID"], types, pos, nodes["Products"], nodes["Demand"], torus)
+    if header["flags"] & BIN_DIST:
+        problem._dist = load("<f8", "dist_off", (n, n))
+    routes = None
+    if header["flags"] & BIN_ROUTES:
+        offsets = load("<i8", "route_off", (int(header["n_routes"])+1,)).tolist()
+        stops = load("<i8", "stop_off", (int(header["n_stops"]),)).tolist()
+        routes = [stops[offsets[r]:offsets[r+1]] for r in range(len(offsets)-1)]
+    return problem, routes
+
 def find_node_by_id (Node_list, ID):
     for node in Node_list:
         if node.ID == ID:
@@ -330,7 +1475,7 @@ def del_files_by_pattern(pattern):
 
 # Main program execution
 if __name__ == "__main__":
-    solver = HSolver()
+    solver = HSolver(export_csv=True)
     # solver.solve_MD_short()
     # solver.solve_VRP_greedy("vrp_1.csv")
     dc_sp, dc_sp_pos, outfiles = solver.solve_MD_short_demand()
@@ -0,0 +1,161 @@
+import glob
+import os
+from collections import deque
+import numpy as np
+import pandas as pd
+
+
+# Define the required Parameters
+
+REC_DIR = "records"     # Folder of the recorded chunks
+REC_CHUNK = 100         # Steps per chunk file
+REC_RING = 100          # Recent steps kept in memory
+
+
+# Define the required Classes
+
+class StepRecorder():
+    """
+    Streaming replacement for the DataCollector tables: every step the model
+    and agent variables and the routes are buffered and written to
+    <folder>/<prefix>_NNNNN.npz every chunk steps (one array per column),
+    so memory stays bounded; the model variables of the last ring steps
+    are kept for the GUI.
+    The chunks of an older run with the same prefix are deleted when the
+    recorder is created or restarted; close() writes the last chunk.
+    model_reporters: {name: function(model)} as for the DataCollector
+    """
+    def __init__(self, model_reporters, folder=REC_DIR, prefix="run", chunk=REC_CHUNK,
+                 ring=REC_RING, agents=True, routes=True):
+        self.model_reporters = model_reporters
+        self.folder = folder
+        self.prefix = prefix
+        self.chunk = chunk
+        self.agents = agents
+        self.routes = routes
+        self.n_chunks = 0
+        # Most recent steps: (step, {name: value})
+        self.recent = deque(maxlen=ring)
+        self._clear()
+        self._delete_chunks()
+
+    def _delete_chunks (self):
+        for file in glob.glob(os.path.join(self.folder, self.prefix + "_[0-9]*.npz")):
+            os.remove(file)
+        self.n_chunks = 0
+
+    def _clear (self):
+        self._steps = []
+        self._model = {name: [] for name in self.model_reporters}
+        self._ids = None
+        self._products = []
+        self._route_stops = []
+        self._route_lens = []
+        self._routes_per_step = []
+
+    def collect (self, model):
+        """Record the current step of model"""
+        step = model.step_counter
+        values = {name: reporter(model) for name, reporter in self.model_reporters.items()}
+        if self.agents:
+            ids, products = agent_products(model)
+            # A chunk holds one agent set (flush if it changed)
+            if self._ids is not None and not np.array_equal(ids, self._ids):
+                self.flush()
+            self._ids = ids
+            self._products.append(products)
+        self._steps.append(step)
+        for name, value in values.items():
+            self._model[name].append(value)
+        self.recent.append((step, values))
+        if self.routes:
+            routes = model.routes or []
+            self._routes_per_step.append(len(routes))
+            for route in routes:
+                self._route_lens.append(len(route))
+                self._route_stops.extend(route)
+        if len(self._steps) >= self.chunk:
+            self.flush()
+
+    def flush (self):
+        """Write the buffered steps to the next chunk file"""
+        if not self._steps:
+            return None
+        os.makedirs(self.folder, exist_ok=True)
+        file = os.path.join(self.folder, "{0}_{1:05d}.npz".format(self.prefix, self.n_chunks))
+        columns = {"step": np.array(self._steps)}
+        for name, values in self._model.items():
+            columns["model_" + name] = np.array(values)
+        if self.agents:
+            columns["agent_ids"] = self._ids
+            columns["agent_products"] = np.array(self._products)
+        if self.routes:
+            columns["routes_per_step"] = np.array(self._routes_per_step, dtype=int)
+            columns["route_lens"] = np.array(self._route_lens, dtype=int)
+            columns["route_stops"] = np.array(self._route_stops, dtype=int)
+        np.savez(file, **columns)
+        self.n_chunks += 1
+        self._clear()
+        return file
+
+    def restart (self):
+        """New model run: drop the buffered steps and the chunks of the last run"""
+        self._clear()
+        self._delete_chunks()
+        self.recent.clear()
+
+    def close (self):
+        """Write the remaining buffered steps (end of the run)"""
+        self.flush()
+
+    def recent_since (self, step, name):
+        """(step, value) of model variable name for the recent steps after step"""
+        points = []
+        # newest first, stopping at the first step already seen
+        for k in range(len(self.recent)-1, -1, -1):
+            recent_step, values = self.recent[k]
+            if recent_step <= step:
+                break
+            points.append((recent_step, values[name]))
+        return points[::-1]
+
+
+# Define the required Functions
+
+def agent_products (model):
+    """IDs and products of the DC/SP agents as arrays"""
+    store = getattr(model, "store", None)
+    if store is not None:
+        return store.ids.copy(), store.products.copy()
+    agents = [agent for agent in model.schedule.agents if agent.type in ("DC", "SP")]
+    ids = np.array([agent.unique_id for agent in agents], dtype=int)
+    products = np.array([agent.products for agent in agents], dtype=float)
+    return ids, products
+
+def load_records (folder=REC_DIR, prefix="run"):
+    """
+    Read back the recorded chunks: DataFrame of the model variables and
+    lists (one entry per step) of agent (ids, products) and routes
+    """
+    files = sorted(glob.glob(os.path.join(folder, prefix + "_[0-9]*.npz")))
+    frames = []
+    agents = []
+    routes = []
+    for file in files:
+        with np.load(file) as data:
+            names = [name for name in data.files if name.startswith("model_")]
+            frame = pd.DataFrame({name[6:]: data[name] for name in names}, index=data["step"])
+            frames.append(frame)
+            if "agent_products" in data.files:
+                ids = data["agent_ids"]
+                agents += [(ids, products) for products in data["agent_products"]]
+            if "route_stops" in data.files:
+                stops = np.split(data["route_stops"], np.cumsum(data["route_lens"])[:-1])
+                if not len(data["route_lens"]):
+                    stops = []
+                start = 0
+                for n_routes in data["routes_per_step"]:
+                    routes.append([route.tolist() for route in stops[start:start+n_routes]])
+                    start += n_routes
+    model_vars = pd.concat(frames) if frames else pd.DataFrame()
+    return model_vars, agents, routes
@@ -0,0 +1,182 @@
+import contextlib
+import io
+import numpy as np
+
+from AB_VRP import *
+
+
+# Define the required Parameters
+
+REPLICAS = 100      # Default number of replicas
+
+
+# Define the required Classes
+
+class ReplicaBatch():
+    """
+    R replicas of MDVRPModel (batch demand mode) on the same layout, advanced
+    in lock-step: products and demand are (R, N) arrays, the depot index and
+    distances are shared, only the routing runs per replica (through one
+    HSolver, so in its process pool if workers != 1).
+    With replicas=1 the results equal MDVRPModel(..., seed, batch_demand=True)
+    """
+    def __init__(self, N_DC, N_SP, width, height, replicas=REPLICAS, seed=None,
+                 dem_av=DEM_AV, dem_sd=DEM_SD, route=True, workers=1, improve=False,
+                 time_budget=None, capacity=None, cluster_size=None):
+        # Layout (IDs, types and positions) of the model with the same seed
+        model = MDVRPModel(N_DC, N_SP, width, height, seed=seed, dem_av=dem_av, dem_sd=dem_sd,
+                           batch_demand=True)
+        with contextlib.redirect_stdout(io.StringIO()):
+            model.initiate()
+        agents = model.dc_agents + model.sp_agents
+        self.N_DC = N_DC
+        self.N_SP = N_SP
+        self.replicas = replicas
+        self.dem_av = dem_av
+        self.dem_sd = dem_sd
+        self.sup_av, self.sup_sd = model.dc_agents[0].calc_supply() if N_DC else (0, 0)
+        self.ids = np.array([agent.unique_id for agent in agents])
+        self.is_dc = np.array([agent.type == "DC" for agent in agents])
+        self.prod_0 = np.where(self.is_dc, PROD_DC, PROD_SP).astype(float)
+        self.problem = Problem([Node(agent.unique_id, agent.type, agent.pos[0], agent.pos[1], 0, 0)
+                                for agent in agents], model.torus)
+        # Distance matrix shared by the sub-problems of all replicas (if not too large)
+        self.dist = self.problem.dist if len(agents) <= DIST_CACHE_MAX else None
+        # Nearest depot of every shop (depots never move)
+        self.depot_index = model.depot_index
+        sp_rows = np.flatnonzero(~self.is_dc)
+        self.sp_depot = np.full(len(agents), -1)
+        if N_DC and len(sp_rows):
+            self.sp_depot[sp_rows] = depot_index_rows(self.depot_index, self.ids, self.problem.pos[sp_rows])
+        self.row_of = {ID: i for i, ID in enumerate(self.ids.tolist())}
+        self.route = route
+        self.solver = HSolver(False, workers, improve, time_budget, capacity=capacity,
+                              cluster_size=cluster_size)
+        self.rng = np.random.default_rng(seed)
+        self.step_counter = -1
+        self.products = np.tile(self.prod_0, (replicas, 1))
+        self.demand = np.zeros((replicas, len(agents)))
+        self.routes = [None] * replicas
+        # Per step and replica (rows: steps), as the model's DataCollector
+        self.stock = []
+        self.route_length = []
+
+    def calculate_stock (self):
+        """Stock of every replica (calculate_stock for each model)"""
+        return self.products.sum(axis=1)
+
+    def generate_demand (self):
+        """MDVRPModel.generate_demand for all replicas at once"""
+        R = self.replicas
+        n_dc = int(self.is_dc.sum())
+        n_sp = len(self.is_dc) - n_dc
+        if n_dc:
+            supply = np.round(self.rng.normal(self.sup_av, self.sup_sd, (R, n_dc)), 0)
+        else:
+            supply = np.zeros((R, 0))
+        trigger = self.rng.random((R, n_sp)) < DEM_PROB
+        demand = np.round(self.rng.normal(self.dem_av, self.dem_sd, (R, n_sp)), 0)
+        demand[~trigger] = 0.0
+        # DC columns first (layout order)
+        self.demand[:, :n_dc] = supply
+        self.products[:, :n_dc] += supply
+        self.demand[:, n_dc:] = demand
+        self.products[:, n_dc:] -= demand
+
+    def node_demand (self):
+        """Demand given to the solver (as MDVRPModel.generate_problem)"""
+        if self.step_counter - 1 > 0:
+            return self.demand
+        # control for step 0 which is not considered in MESA
+        return self.products - self.prod_0
+
+    def subproblems (self, demand):
+        """
+        Depot sub-problems of every replica (as HSolver.solve_MD_short_demand)
+        Returns one list of sub-problems per replica
+        """
+        problem = self.problem
+        subs = [[] for r in range(self.replicas)]
+        # Shops with demand of all replicas, grouped by replica and depot
+        r_all, shops_all = np.nonzero(~self.is_dc & (demand != 0))
+        if len(r_all) == 0:
+            return subs
+        depots_all = self.sp_depot[shops_all]
+        order = np.lexsort((shops_all, depots_all, r_all))
+        r_all, shops_all, depots_all = r_all[order], shops_all[order], depots_all[order]
+        bounds = np.flatnonzero(np.diff(r_all)) + 1
+        starts = np.concatenate(([0], bounds)).tolist()
+        ends = np.concatenate((bounds, [len(r_all)])).tolist()
+        for start, end in zip(starts, ends):
+            r = int(r_all[start])
+            shops = shops_all[start:end]
+            depots = depots_all[start:end]
+            demand_r = demand[r]
+            last = self.ids[depots].max()
+            for j in np.flatnonzero(self.is_dc & (self.ids <= last)).tolist():
+                rows = np.concatenate(([j], shops[depots == j]))
+                sub = Problem(None, problem.torus, problem.pos[rows], demand_r[rows], ~self.is_dc[rows],
+                              self.ids[rows], self.products[r, rows])
+                if self.dist is not None:
+                    sub._dist = self.dist[rows[:, np.newaxis], rows]
+                subs[r].append(sub)
+        return subs
+
+    def routes_length (self):
+        """Total route length of every replica (closed routes)"""
+        orig = []
+        dest = []
+        owner = []
+        for r, routes in enumerate(self.routes):
+            for route in routes or []:
+                if len(route) > 1:
+                    rows = [self.row_of[ID] for ID in route]
+                    orig += rows
+                    dest += rows[1:] + rows[:1]
+                    owner += [r] * len(rows)
+        if self.dist is not None:
+            arcs = self.dist[orig, dest]
+        else:
+            arcs = calc_dist_pairs(self.problem.pos[orig], self.problem.pos[dest], self.problem.torus)
+        return np.bincount(np.array(owner, dtype=int), weights=arcs, minlength=self.replicas)
+
+    def step (self):
+        self.step_counter += 1
+        self.stock.append(self.calculate_stock())
+        self.generate_demand()
+        if not self.route:
+            return
+        subs = self.subproblems(self.node_demand())
+        # All depots of all replicas in one call (process pool if workers != 1)
+        solved = iter(self.solver.solve_depots([sub for s in subs for sub in s]))
+        for r, s in enumerate(subs):
+            routes = []
+            for sub in s:
+                routes.extend(next(solved))
+            self.routes[r] = routes
+        self.route_length.append(self.routes_length())
+
+    def run (self, steps):
+        """Advance every replica steps times; returns the stock series (steps, R)"""
+        for i in range(steps):
+            self.step()
+        return self.stock_series()
+
+    def stock_series (self):
+        return np.array(self.stock).reshape(-1, self.replicas)
+
+
+# Define the required Functions
+
+def depot_index_rows (depot_index, ids, pos):
+    """Row (in ids) of the nearest depot for every position"""
+    row_of = {ID: i for i, ID in enumerate(ids.tolist())}
+    return np.array([row_of[depot_index.ids[j]] for j in depot_index.nearest(pos)])
+
+
+# Main program execution
+if __name__ == "__main__":
+    batch = ReplicaBatch(3, 15, 300, 300, replicas=1000, seed=0)
+    stock = batch.run(100)
+    print("Stock after {0} steps: mean {1:.1f}, st dev {2:.1f}".format(len(stock), stock[-1].mean(),
+                                                                        stock[-1].std()))
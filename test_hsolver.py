@@ -0,0 +1,139 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+from hsolver import *
+
+
+# Define the required Functions
+
+def random_problem (n_dc=3, n_sp=60, size=300, seed=0, torus=True):
+    """Problem with n_dc depots and n_sp shops (about half with demand)"""
+    rng = np.random.default_rng(seed)
+    n = n_dc + n_sp
+    ids = list(range(n_dc)) + list(range(1000, 1000+n_sp))
+    types = ["DC"]*n_dc + ["SP"]*n_sp
+    pos = rng.integers(0, size, (n, 2))
+    products = np.where(np.arange(n) < n_dc, 200, 10)
+    demand = np.where(rng.random(n) < 0.5, rng.integers(1, 15, n), 0)
+    demand[:n_dc] = 0
+    return Problem.from_arrays(ids, types, pos, products, demand, (size, size) if torus else None)
+
+def solve (solver, problem):
+    with contextlib.redirect_stdout(io.StringIO()):
+        dc_sp, dc_sp_pos, subproblems = solver.solve_MD_short_demand(problem)
+        return solver.aggregate_VRP(*subproblems, problem=problem)
+
+def check_routes (problem, routes, capacity=None):
+    """Every shop with demand is routed exactly once, from a depot, within capacity"""
+    stops = sorted(ID for route in routes for ID in route[1:])
+    assert stops == sorted(problem.ids[problem.demand_shops()].tolist())
+    for route in routes:
+        assert not problem.is_sp[problem.row_of(route[0])]
+        if capacity is not None and len(route) > 2:
+            assert np.abs(problem.demand[[problem.row_of(ID) for ID in route[1:]]]).sum() <= capacity
+
+
+# Tests
+
+SOLVERS = [dict(), dict(improve=True), dict(capacity=30), dict(capacity=30, improve=True),
+           dict(balance=True), dict(cluster_size=5), dict(cluster_size=5, capacity=30)]
+
+@pytest.mark.parametrize("options", SOLVERS)
+def test_every_shop_routed_once (options):
+    for seed in range(3):
+        problem = random_problem(seed=seed)
+        routes = solve(HSolver(**options), problem)
+        check_routes(problem, routes, options.get("capacity"))
+
+@pytest.mark.parametrize("options", [dict(), dict(capacity=30), dict(improve=True),
+                                     dict(balance=True, capacity=30)])
+def test_reroute_every_shop_routed_once (options):
+    solver = HSolver(**options)
+    problem = random_problem(seed=0)
+    routes = solve(solver, problem)
+    for seed in range(1, 5):
+        # same layout, new demand
+        demand = random_problem(seed=seed).demand
+        problem = Problem.from_arrays(problem.ids, np.where(problem.is_sp, "SP", "DC"), problem.pos,
+                                      problem.products, demand, problem.torus)
+        routes = solver.reroute(problem, routes)
+        check_routes(problem, routes, options.get("capacity"))
+        # same route list rules as a full solve
+        assert [route[0] for route in routes] == sorted(route[0] for route in routes)
+        if "capacity" not in options:
+            assert [route[0] for route in routes] == [route[0] for route in solve(solver, problem)]
+
+def test_local_search_never_longer ():
+    for seed in range(3):
+        problem = random_problem(n_dc=1, n_sp=300, seed=seed)
+        order = nearest_neighbour_order(problem)
+        for pos in (None, problem.pos):
+            ls = LocalSearch(problem.dist, pos=pos, torus=problem.torus)
+            improved = ls.improve(order, max_iter=2000)
+            assert sorted(improved) == sorted(order)
+            assert improved[0] == order[0]
+            assert route_length(problem.dist, improved) <= route_length(problem.dist, order) + 1e-9
+
+def test_savings_trips_within_capacity ():
+    problem = random_problem(n_dc=1, n_sp=80, seed=1)
+    vrp = problem.subproblem([0] + problem.demand_shops())
+    trips = savings_trips(vrp, 30)
+    assert sorted(i for trip in trips for i in trip) == list(range(1, len(vrp.ids)))
+    for trip in trips:
+        assert len(trip) == 1 or np.abs(vrp.demand[trip]).sum() <= 30
+
+def test_regret_assignment_respects_stock ():
+    problem = random_problem(n_dc=4, n_sp=100, seed=2)
+    depots = problem.depot_index()
+    shops = problem.demand_shops()
+    demand = np.abs(problem.demand[shops])
+    dist, near = depots.query(problem.pos[shops], 4)
+    # enough stock in total: no depot gives more than its stock
+    stock = np.full(4, demand.sum() / 3)
+    assigned = regret_assignment(demand, stock, dist, near)
+    assert np.all(np.bincount(assigned, weights=demand, minlength=4) <= stock + 1e-9)
+
+def test_angular_sectors_partition ():
+    problem = random_problem(n_dc=1, n_sp=50, seed=3)
+    sectors = angular_sectors(problem, 7)
+    assert sorted(i for sector in sectors for i in sector) == list(range(1, 51))
+    assert all(0 < len(sector) <= 7 for sector in sectors)
+
+@pytest.mark.parametrize("dist", [True, False])
+def test_binary_round_trip (tmp_path, dist):
+    problem = random_problem(seed=4)
+    routes = solve(HSolver(), problem)
+    bin_f = str(tmp_path / "problem.bin")
+    write_binary(bin_f, problem, routes, dist)
+    for mmap in (True, False):
+        read, read_routes = read_binary(bin_f, mmap)
+        assert read_routes == routes
+        assert read.torus == problem.torus
+        for column in ("ids", "pos", "products", "demand", "is_sp"):
+            assert np.array_equal(getattr(read, column), getattr(problem, column))
+        if dist:
+            assert np.allclose(read._dist, problem.dist)
+        del read
+
+def test_binary_update_keeps_matrix (tmp_path):
+    problem = random_problem(seed=5)
+    bin_f = str(tmp_path / "problem.bin")
+    write_binary(bin_f, problem, [[0]])
+    # new demand and routes on the same layout
+    update = Problem.from_arrays(problem.ids, np.where(problem.is_sp, "SP", "DC"), problem.pos,
+                                 problem.products, random_problem(seed=6).demand, problem.torus)
+    routes = solve(HSolver(), update)
+    write_binary(bin_f, update, routes, update=True)
+    read, read_routes = read_binary(bin_f, mmap=False)
+    assert read_routes == routes
+    assert np.array_equal(read.demand, update.demand)
+    assert np.allclose(read._dist, problem.dist)
+
+@pytest.mark.parametrize("options", [dict(k=3), dict(radius=50.0)])
+def test_sparse_network_empty (options):
+    network = SparseNetwork(np.empty((0, 2)), **options)
+    assert network.n_arcs == 0
+    assert network.indptr.tolist() == [0]
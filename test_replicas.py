@@ -0,0 +1,28 @@
+import contextlib
+import io
+
+import pytest
+
+from replicas import *
+
+
+@pytest.mark.parametrize("capacity, cluster_size", [(None, None), (40, None), (None, 3)])
+def test_single_replica_matches_model (capacity, cluster_size):
+    """replicas=1 gives the stock and routes of MDVRPModel(seed, batch_demand=True)"""
+    steps = 30
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch = ReplicaBatch(3, 15, 300, 300, replicas=1, seed=0, capacity=capacity,
+                             cluster_size=cluster_size)
+        model = MDVRPModel(3, 15, 300, 300, seed=0, batch_demand=True, capacity=capacity,
+                           cluster_size=cluster_size)
+        model.initiate()
+        no_demand = 0
+        for i in range(steps):
+            batch.step()
+            model.step()
+            assert batch.routes[0] == model.routes
+            no_demand += model.routes == []
+    stock = model.datacollector.get_model_vars_dataframe()["Stock"].tolist()
+    assert batch.stock_series()[:, 0].tolist() == stock
+    # seed 0 has a step without any demand (step 26)
+    assert no_demand > 0